@@ -1,14 +1,35 @@
+from typing import Any
+
 from wsgidav import http_authenticator
 from wsgidav.http_authenticator import HTTPAuthenticator
 from wsgidav.wsgidav_app import WsgiDAVApp
 
 from .auth import ManabiAuthenticator
+from .filesystem import ManabiS3Provider
+from .token import Keyring
 
 
 class ManabiDAVApp(WsgiDAVApp):
     def __init__(self, config):
         super().__init__(config)
         self.lock_manager._lock = config["lock_storage"]._lock  # type: ignore
+        self._start_journals(config)
+
+    def _start_journals(self, config) -> None:
+        # Replayed saves need the keys for their post-write hooks
+        keyring = Keyring.from_dictionary(config)
+        for provider in self.provider_map.values():
+            if isinstance(provider, ManabiS3Provider):
+                provider.start_journal(keyring)
+
+    def reload_manabi_config(self, config=None):
+        """Let the ManabiAuthenticator parse the manabi config again."""
+        self._start_journals(config or self.config)
+        app: Any = self.application
+        while app is not None and app is not self:
+            if isinstance(app, ManabiAuthenticator):
+                app.reload_config(config)
+            app = getattr(app, "next_app", None)
 
 
 class MetaFakeHTTPAuthenticator(type(http_authenticator.HTTPAuthenticator)):  # type: ignore
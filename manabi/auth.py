@@ -1,26 +1,125 @@
+import time
 from functools import partial
 from http.cookies import SimpleCookie
 from pathlib import Path
-from typing import Any, Callable, Dict, List
+from typing import Any, Callable, Dict, List, Optional
 from unittest.mock import MagicMock
 
+from attr import Factory, attrib, dataclass
+from attr.validators import instance_of, optional
 from wsgidav.mw.base_mw import BaseMiddleware
 
-from .token import Config, State, Token
-from .util import AppInfo, get_rfc1123_time, set_cookie
+from .revocation import RevocationStore
+from .token import (
+    TTL,
+    Config,
+    Key,
+    Keyring,
+    State,
+    Token,
+    ciphertext_timestamp,
+    is_decode_cached,
+    now,
+)
+from .util import (
+    COOKIE_PREFIX,
+    AppInfo,
+    LRUCache,
+    RateLimiter,
+    SetCookie,
+    cookie_name,
+    get_cookie,
+    http_date,
+)
 
-_error_message_403 = """
+_error_message = """
 <html>
-    <head><title>403 Forbidden</title></head>
+    <head><title>{0}</title></head>
     <body>
-        <h1>403 Forbidden</h1>
-        {0}
+        <h1>{0}</h1>
+        {1}
     </body>
 </html>
 """.strip()
 
 
+@dataclass(frozen=True)
+class AuthConfig:
+    """The manabi section of the config, parsed and validated once."""
+
+    # Frozen classes can't use cattrib, it validates on setattr
+    key: Key = attrib(validator=instance_of(Key))
+    ttl: TTL = attrib(validator=instance_of(TTL))
+    keyring: Keyring = attrib(validator=instance_of(Keyring))
+    secure: bool = attrib(validator=instance_of(bool), default=True)
+    # Refresh cookies younger than this (seconds) are not re-issued
+    reissue: int = attrib(validator=instance_of(int), default=0)
+    # More refresh cookies than this are expired, oldest first
+    cookie_limit: int = attrib(validator=instance_of(int), default=16)
+    # Renders the refresh cookie
+    set_cookie: SetCookie = attrib(
+        validator=instance_of(SetCookie),
+        default=Factory(lambda s: SetCookie(s.ttl.refresh, s.secure), takes_self=True),
+    )
+    # How many undecodable tokens are remembered
+    rejected_cache: int = attrib(validator=instance_of(int), default=1024)
+    # Failures per second and burst allowed per client address, None disables it
+    failure_rate: Optional[float] = attrib(
+        validator=optional(instance_of((int, float))), default=None
+    )
+    failure_burst: int = attrib(validator=instance_of(int), default=20)
+    # Revoked tokens, None disables revocation
+    revocation: Optional[RevocationStore] = attrib(
+        validator=optional(instance_of((RevocationStore,))), default=None
+    )
+
+    @classmethod
+    def from_dictionary(cls, config: dict) -> "AuthConfig":
+        cfg = Config.from_dictionary(config)
+        manabi = config["manabi"]
+        secure = manabi.get("secure", True)
+        return cls(
+            key=cfg.key,
+            ttl=cfg.ttl,
+            keyring=cfg.keyring,
+            secure=secure,
+            reissue=manabi.get("reissue", cfg.ttl.refresh // 2),
+            cookie_limit=manabi.get("cookie_limit", 16),
+            set_cookie=SetCookie(cfg.ttl.refresh, secure, manabi.get("cookie_path")),
+            rejected_cache=manabi.get("rejected_cache", 1024),
+            failure_rate=manabi.get("failure_rate"),
+            failure_burst=manabi.get("failure_burst", 20),
+            revocation=RevocationStore.from_dictionary(config),
+        )
+
+
 class ManabiAuthenticator(BaseMiddleware):
+    auth_config: AuthConfig
+    # Undecodable tokens and why they were rejected
+    rejected: LRUCache
+    limiter: Optional[RateLimiter]
+
+    def __init__(self, wsgidav_app, next_app, config: Dict[str, Any]):
+        super().__init__(wsgidav_app, next_app, config)
+        self.reload_config()
+
+    def reload_config(self, config: Optional[Dict[str, Any]] = None) -> None:
+        """Parse the manabi config again, for example after the key changed.
+
+        Requests already in progress keep using the config they started with.
+        """
+        if config is not None:
+            self.config = config
+        auth_config = AuthConfig.from_dictionary(self.config)
+        # A new key might make rejected tokens valid
+        self.rejected = LRUCache(auth_config.rejected_cache)
+        self.limiter = None
+        if auth_config.failure_rate is not None:
+            self.limiter = RateLimiter(
+                auth_config.failure_rate, auth_config.failure_burst
+            )
+        self.auth_config = auth_config
+
     # Instead of accepting an override for HTTPAuthenticator as for everything else,
     # wsgidav just expects a class extending HTTPAuthenticator in the middleware_stack.
     # In it also accesses the domain_controller with out check if it exists in some debug code.
@@ -29,27 +128,38 @@ class ManabiAuthenticator(BaseMiddleware):
         return MagicMock()
 
     def manabi_secure(self) -> bool:
-        config = self.config
-        if "manabi" not in config:
-            return True
-        manabi = config["manabi"]
-        if "secure" not in manabi:
-            return True
-        return manabi["secure"]
+        return self.auth_config.secure
 
     def access_denied(self, start_response: Callable, reason: str = "") -> List[bytes]:
-        body = _error_message_403
-        content = body.format(reason).encode("UTF-8")
+        return self.error(start_response, "403 Forbidden", reason)
+
+    def reject(self, environ: Dict[str, Any], start_response: Callable, reason: str):
+        """Deny access and count the failure against the client."""
+        if self.limiter:
+            self.limiter.hit(environ.get("REMOTE_ADDR"))
+        return self.access_denied(start_response, reason)
+
+    def error(self, start_response: Callable, status: str, reason: str) -> List[bytes]:
+        content = _error_message.format(status, reason).encode("UTF-8")
         start_response(
-            "403 Forbidden",
+            status,
             [
                 ("Content-Type", "text/html"),
                 ("Content-Length", str(len(content))),
-                ("Date", get_rfc1123_time()),
+                ("Date", http_date(int(time.time()))),
             ],
         )
         return [content]
 
+    def denied(self, config: AuthConfig, id_: str) -> Optional[str]:
+        """Return why the token is denied without decoding it, if it is."""
+        reason = self.rejected.get(id_)
+        if reason is None:
+            revocation = config.revocation
+            if revocation is not None and revocation.revoked(id_):
+                reason = "the token was revoked"
+        return reason
+
     def update_env(self, info: AppInfo, token: Token, id_: str, dir_access: bool):
         environ = info.environ
         # Update the path for security, so we can't ever be tricked into serving a
@@ -62,14 +172,61 @@ class ManabiAuthenticator(BaseMiddleware):
         environ["wsgidav.auth.user_name"] = f"{path.strip('/')}|{id_[10:18]}"
         environ["manabi.token"] = token
 
+    def pass_through(self, id_: str, info: AppInfo, token: Token, dir_access: bool):
+        self.update_env(info, token, id_, dir_access)
+        return self.next_app(info.environ, info.start_response)
+
+    def stale_cookies(self, cookie: Optional[str], id_: str) -> List[str]:
+        """Return the names of refresh cookies the client should drop.
+
+        These are cookies of other documents that are expired or exceed the
+        cookie_limit and the cookie of this document if it still has the old name.
+        """
+        if not cookie:
+            return []
+        jar = SimpleCookie(cookie)
+        config = self.auth_config
+        current = cookie_name(id_)
+        stale = []
+        live = []
+        expired = now() - config.ttl.refresh
+        for name, morsel in jar.items():
+            if name == id_:
+                stale.append(name)
+            elif name.startswith(COOKIE_PREFIX) and name != current:
+                timestamp = ciphertext_timestamp(morsel.value)
+                if timestamp is None or timestamp < expired:
+                    stale.append(name)
+                else:
+                    live.append((timestamp, name))
+        # Keep room for the current cookie
+        excess = len(live) - (config.cookie_limit - 1)
+        if excess > 0:
+            live.sort()
+            stale.extend(name for _, name in live[:excess])
+        return stale
+
     def refresh(
-        self, id_: str, info: AppInfo, token: Token, ttl: int, dir_access: bool
+        self,
+        id_: str,
+        info: AppInfo,
+        token: Token,
+        dir_access: bool,
+        cookie: Optional[str] = None,
     ):
-        new = Token.from_token(token)
+        config = self.auth_config
+        # Tokens of retired keys are refreshed with the primary key
+        new = Token.from_token(token, key=config.key)
         self.update_env(info, token, id_, dir_access)
         return self.next_app(
             info.environ,
-            partial(set_cookie, info, id_, new.encode(), ttl),
+            partial(
+                config.set_cookie.start_response,
+                info.start_response,
+                cookie_name(id_),
+                new.encode(),
+                expire=self.stale_cookies(cookie, id_),
+            ),
         )
 
     def __call__(
@@ -84,32 +241,57 @@ class ManabiAuthenticator(BaseMiddleware):
         start_response with a closure, if they want to add headers.
         https://www.python.org/dev/peps/pep-3333/
         """
-        info = AppInfo(start_response, environ, self.manabi_secure())
-        config = Config.from_dictionary(environ["wsgidav.config"])
+        config = self.auth_config
+        # The wsgi server is the trust boundary for start_response and environ
+        info = AppInfo.trusted(start_response, environ, config.secure)
         path_info = environ["PATH_INFO"]
         id_, _, suffix = path_info.strip("/").partition("/")
         suffix = suffix.strip("/")
         # We need this in order to correctly set environ["PATH_INFO"]
         dir_access = suffix == ""
         if not id_:
-            return self.access_denied(start_response, "no token supplied")
-        initial = Token.from_ciphertext(config.key, id_)
+            return self.reject(environ, start_response, "no token supplied")
+        limiter = self.limiter
+        if (
+            limiter
+            and limiter.limited(environ.get("REMOTE_ADDR"))
+            and not is_decode_cached(config.keyring, id_)
+        ):
+            # Only tokens that were valid before get through, they cost no decryption
+            return self.error(
+                start_response, "429 Too Many Requests", "too many failed requests"
+            )
+        reason = self.denied(config, id_)
+        if reason is not None:
+            return self.reject(environ, start_response, reason)
+        initial = Token.from_ciphertext(config.keyring, id_)
         check = initial.check()
 
         if check == State.invalid:
-            return self.access_denied(start_response, check.value[1])
+            reason = check.value[1]
+            self.rejected.set(id_, reason)
+            return self.reject(environ, start_response, reason)
 
         cookie = environ.get("HTTP_COOKIE")
-        ttl = config.ttl.refresh
         if cookie:
-            cookie = SimpleCookie(cookie)
-            refresh_cookie = cookie.get(initial.ciphertext)
-            if refresh_cookie and refresh_cookie.value:
-                refresh = Token.from_ciphertext(config.key, refresh_cookie.value)
-                if refresh.refresh(config.ttl) == State.valid:
-                    return self.refresh(id_, info, refresh, ttl, dir_access)
+            # Cookies used to be named after the token
+            name = cookie_name(id_)
+            refresh_cookie = get_cookie(cookie, name) or get_cookie(cookie, id_)
+            if refresh_cookie:
+                refresh = Token.from_ciphertext(config.keyring, refresh_cookie)
+                if (
+                    refresh.refresh(config.ttl) == State.valid
+                    and refresh.path == initial.path
+                ):
+                    # The cookie is still fresh, save the encryption and the header
+                    age = refresh.age() or 0
+                    if refresh.key == config.key and age < config.reissue:
+                        return self.pass_through(id_, info, refresh, dir_access)
+                    return self.refresh(id_, info, refresh, dir_access, cookie)
 
+        # Without valid refresh cookie the initial token always gets one, otherwise
+        # the session would end after ttl.initial if the client is idle.
         check = initial.initial(config.ttl)
         if initial.initial(config.ttl) == State.valid:
-            return self.refresh(id_, info, initial, ttl, dir_access)
-        return self.access_denied(start_response, check.value[1])
+            return self.refresh(id_, info, initial, dir_access, cookie)
+        return self.reject(environ, start_response, check.value[1])
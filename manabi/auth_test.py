@@ -1,6 +1,7 @@
 from collections.abc import Generator
 from pathlib import Path
-from typing import cast
+from typing import Any, Dict, List, Optional, cast
+from unittest.mock import patch
 from urllib.parse import quote
 
 import pytest
@@ -8,7 +9,10 @@ import requests
 from hypothesis import assume, example, given
 from hypothesis.strategies import binary, booleans, lists, permutations, text
 
-from . import mock
+from . import ManabiDAVApp, mock
+from .auth import ManabiAuthenticator
+from .token import Key, Token, now
+from .util import cookie_name, from_string
 
 
 @pytest.fixture(scope="module")
@@ -18,6 +22,211 @@ def mod_server() -> Generator:
             yield
 
 
+def stub_app(environ, start_response):
+    start_response("200 OK", [])
+    return [environ["PATH_INFO"].encode("UTF-8")]
+
+
+class Response:
+    status: str
+    headers: List
+    body: bytes
+
+    def __call__(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = headers
+
+
+def call_auth(
+    auth: ManabiAuthenticator,
+    url: str,
+    cookie: Optional[str] = None,
+    remote: str = "127.0.0.1",
+) -> Response:
+    environ: Dict[str, Any] = {"PATH_INFO": f"/{url}", "REMOTE_ADDR": remote}
+    if cookie:
+        environ["HTTP_COOKIE"] = cookie
+    res = Response()
+    res.body = b"".join(auth(environ, res))
+    return res
+
+
+def test_auth_config_parsed_once():
+    with mock.with_config() as config:
+        auth = ManabiAuthenticator(None, stub_app, config)
+        url = mock.make_token(config).as_url()
+        with patch("manabi.auth.Config.from_dictionary") as from_dictionary:
+            assert call_auth(auth, url).status == "200 OK"
+            assert call_auth(auth, url).status == "200 OK"
+            from_dictionary.assert_not_called()
+
+
+def test_auth_config_reload():
+    with mock.with_config() as config:
+        auth = ManabiAuthenticator(None, stub_app, config)
+        url = mock.make_token(config).as_url()
+        assert auth.manabi_secure()
+        config["manabi"]["key"] = "bNEZsIjvxDAiLhDA1chvF9zL9OJYPNlCqNPlm7KbhmU"
+        config["manabi"]["secure"] = False
+        assert call_auth(auth, url).status == "200 OK"
+        auth.reload_config()
+        assert auth.auth_config.key.data == from_string(config["manabi"]["key"])
+        assert not auth.manabi_secure()
+        assert call_auth(auth, url).status == "403 Forbidden"
+
+
+def test_auth_key_rotation():
+    with mock.with_config() as config:
+        url = mock.make_token(config).as_url()
+        config["manabi"]["keys"] = {"": config["manabi"]["key"]}
+        config["manabi"]["key"] = "bNEZsIjvxDAiLhDA1chvF9zL9OJYPNlCqNPlm7KbhmU"
+        config["manabi"]["key_id"] = "k2"
+        auth = ManabiAuthenticator(None, stub_app, config)
+        res = call_auth(auth, url)
+        assert res.status == "200 OK"
+        _, _, value = dict(res.headers)["Set-Cookie"].partition("=")
+        assert value.startswith("k2.")
+        assert call_auth(auth, mock.make_token(config).as_url()).status == "200 OK"
+        del config["manabi"]["keys"]
+        auth.reload_config()
+        assert call_auth(auth, url).status == "403 Forbidden"
+
+
+def test_auth_reissue():
+    with mock.with_config() as config:
+        auth = ManabiAuthenticator(None, stub_app, config)
+        assert auth.auth_config.reissue == 300
+        url = mock.make_token(config).as_url()
+        res = call_auth(auth, url)
+        cookie = dict(res.headers)["Set-Cookie"].partition(";")[0]
+        res = call_auth(auth, url, cookie)
+        assert res.status == "200 OK"
+        assert res.headers == []
+        assert res.body == b"/asdf.docx"
+        with mock.shift_now(400):
+            res = call_auth(auth, url, cookie)
+        assert res.status == "200 OK"
+        assert "Set-Cookie" in dict(res.headers)
+        config["manabi"]["reissue"] = 0
+        auth.reload_config()
+        assert "Set-Cookie" in dict(call_auth(auth, url, cookie).headers)
+
+
+def set_cookies(res: Response) -> Dict[str, str]:
+    cookies = {}
+    for header, value in res.headers:
+        if header == "Set-Cookie":
+            name, _, rest = value.partition("=")
+            cookies[name] = rest.partition(";")[0].strip('"')
+    return cookies
+
+
+def test_auth_cookie_name():
+    with mock.with_config() as config:
+        auth = ManabiAuthenticator(None, stub_app, config)
+        token = mock.make_token(config)
+        url = token.as_url()
+        name = cookie_name(token.ciphertext)
+        assert len(name) == len(cookie_name("x" * 1000))
+        res = call_auth(auth, url)
+        assert list(set_cookies(res)) == [name]
+        # Cookies named after the token are still accepted, but expired
+        value = set_cookies(res)[name]
+        res = call_auth(auth, url, f"{token.ciphertext}={value}")
+        assert res.headers == []
+        config["manabi"]["reissue"] = 0
+        auth.reload_config()
+        res = call_auth(auth, url, f"{token.ciphertext}={value}")
+        assert set_cookies(res)[token.ciphertext] == ""
+        assert name in set_cookies(res)
+        # The cookie of another document is not accepted
+        other = mock.make_token(config, Path("qwert.docx"))
+        other.encode()
+        res = call_auth(
+            auth, other.as_url(), f"{cookie_name(other.ciphertext)}={value}"
+        )
+        assert res.body == b"/qwert.docx"
+
+
+def test_auth_prune_cookies():
+    with mock.with_config() as config:
+        config["manabi"]["cookie_limit"] = 3
+        auth = ManabiAuthenticator(None, stub_app, config)
+        key = Key.from_dictionary(config)
+        url = mock.make_token(config).as_url()
+        t = now()
+        cookies = {
+            "expired": Token(key, Path("a"), timestamp=t - 700).encode(),
+            "old": Token(key, Path("b"), timestamp=t - 300).encode(),
+            "older": Token(key, Path("c"), timestamp=t - 400).encode(),
+            "new": Token(key, Path("d"), timestamp=t - 10).encode(),
+            "broken": "garbage",
+        }
+        names = {k: cookie_name(v) for k, v in cookies.items()}
+        jar = "; ".join(f"{names[k]}={v}" for k, v in cookies.items())
+        res = call_auth(auth, url, f"{jar}; other=1")
+        expired = {k for k, v in set_cookies(res).items() if not v}
+        assert expired == {names["expired"], names["older"], names["broken"]}
+        assert len(set_cookies(res)) == 4
+
+
+def test_auth_rejected_cache():
+    with mock.with_config() as config:
+        auth = ManabiAuthenticator(None, stub_app, config)
+        res = call_auth(auth, "garbage/asdf.docx")
+        assert res.status == "403 Forbidden"
+        assert b"authentication failed" in res.body
+        with patch("manabi.auth.Token.from_ciphertext") as from_ciphertext:
+            res = call_auth(auth, "garbage/asdf.docx")
+            from_ciphertext.assert_not_called()
+        assert res.status == "403 Forbidden"
+        assert b"authentication failed" in res.body
+        auth.reload_config()
+        assert "garbage" not in auth.rejected
+
+
+def test_auth_failure_limit():
+    with mock.with_config() as config:
+        config["manabi"]["failure_rate"] = 0.01
+        config["manabi"]["failure_burst"] = 3
+        auth = ManabiAuthenticator(None, stub_app, config)
+        url = mock.make_token(config).as_url()
+        assert call_auth(auth, url).status == "200 OK"
+        for i in range(3):
+            assert call_auth(auth, f"bad{i}/x").status == "403 Forbidden"
+        assert call_auth(auth, "bad4/x").status == "429 Too Many Requests"
+        assert call_auth(auth, "bad4/x", remote="10.0.0.1").status == "403 Forbidden"
+        # Valid sessions are not starved
+        assert call_auth(auth, url).status == "200 OK"
+        new = mock.make_token(config, Path("qwert.docx")).as_url()
+        assert call_auth(auth, new).status == "429 Too Many Requests"
+
+
+def test_auth_revoked(tmp_path):
+    with mock.with_config() as config:
+        revoked = tmp_path / "revoked"
+        config["manabi"]["revoked_file"] = str(revoked)
+        auth = ManabiAuthenticator(None, stub_app, config)
+        url = mock.make_token(config).as_url()
+        res = call_auth(auth, url)
+        assert res.status == "200 OK"
+        cookie = "; ".join(set_cookies(res))
+        revoked.write_text(f"{url.partition('/')[0]}\n")
+        auth.reload_config()
+        res = call_auth(auth, url, cookie)
+        assert res.status == "403 Forbidden"
+        assert b"revoked" in res.body
+
+
+def test_dav_app_reload_config():
+    with mock.with_config() as config:
+        app = ManabiDAVApp(config)
+        config["manabi"]["secure"] = False
+        with patch.object(ManabiAuthenticator, "reload_config") as reload_config:
+            app.reload_manabi_config(config)
+            reload_config.assert_called_once_with(config)
+
+
 def format_req(url):
     try:
         path = str(Path(f"/dav/{url}").resolve())
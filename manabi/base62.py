@@ -0,0 +1,100 @@
+"""Base62 codec, compatible with pybase62, which branca uses for tokens.
+
+pybase62 converts one digit at a time with bignum arithmetic. Here the conversion
+between bytes and int is done by int.from_bytes/to_bytes, digits are converted in
+chunks of 10 (62**10 fits a machine word) using lookup tables and long strings
+are decoded by splitting them in halves, which uses Karatsuba multiplication.
+"""
+
+from functools import lru_cache
+
+CHARSET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+BASE = 62
+
+_CHUNK = 10
+_CHUNK_BASE = BASE**_CHUNK
+_PAIR_BASE = BASE**2
+# Strings longer than this are decoded by splitting them
+_SPLIT = 400
+_VALUES = {char: value for value, char in enumerate(CHARSET)}
+_PAIRS = [a + b for a in CHARSET for b in CHARSET]
+
+
+@lru_cache(maxsize=64)
+def _power(exponent: int) -> int:
+    return BASE**exponent
+
+
+def _value(char: str) -> int:
+    try:
+        return _VALUES[char]
+    except KeyError:
+        raise ValueError(f"base62: Invalid character ({char})") from None
+
+
+def encode(value: int) -> str:
+    """Encode a non-negative integer."""
+    if value <= 0:
+        return "0"
+    pairs = _PAIRS
+    chunks = []
+    while value >= _CHUNK_BASE:
+        value, chunk = divmod(value, _CHUNK_BASE)
+        # Exactly 10 digits, as 5 pairs
+        chunk, p0 = divmod(chunk, _PAIR_BASE)
+        chunk, p1 = divmod(chunk, _PAIR_BASE)
+        chunk, p2 = divmod(chunk, _PAIR_BASE)
+        p4, p3 = divmod(chunk, _PAIR_BASE)
+        chunks.append(pairs[p4] + pairs[p3] + pairs[p2] + pairs[p1] + pairs[p0])
+    first = []
+    while value:
+        value, pair = divmod(value, _PAIR_BASE)
+        first.append(pairs[pair])
+    chunks.append("".join(reversed(first)).lstrip("0"))
+    return "".join(reversed(chunks))
+
+
+def decode(encoded: str) -> int:
+    """Decode base62 digits into an integer."""
+    size = len(encoded)
+    if size > _SPLIT:
+        low = size // 2
+        high = decode(encoded[: size - low])
+        return high * _power(low) + decode(encoded[size - low :])
+    result = 0
+    for start in range(0, size, _CHUNK):
+        chunk = encoded[start : start + _CHUNK]
+        value = 0
+        for char in chunk:
+            value = value * BASE + _value(char)
+        result = result * _power(len(chunk)) + value
+    return result
+
+
+def encodebytes(data: bytes) -> str:
+    """Encode bytes, leading null bytes are encoded as `0<count>`."""
+    if not isinstance(data, bytes):
+        raise TypeError(f"Expected bytes object, not {data.__class__.__name__}")
+    stripped = data.lstrip(b"\x00")
+    zeros = len(data) - len(stripped)
+    full, rest = divmod(zeros, BASE - 1)
+    padding = f"0{CHARSET[-1]}" * full
+    if rest:
+        padding += f"0{CHARSET[rest]}"
+    if not stripped:
+        return padding
+    return padding + encode(int.from_bytes(stripped, "big"))
+
+
+def decodebytes(encoded: str) -> bytes:
+    """Decode a string created by encodebytes."""
+    if not isinstance(encoded, str):
+        raise TypeError(f"Expected str object, not {encoded.__class__.__name__}")
+    zeros = 0
+    start = 0
+    while encoded.startswith("0", start) and len(encoded) - start >= 2:
+        zeros += _value(encoded[start + 1])
+        start += 2
+    value = decode(encoded[start:])
+    data = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return b"\x00" * zeros + data
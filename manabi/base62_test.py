@@ -0,0 +1,55 @@
+import base62 as pybase62  # type: ignore
+import pytest
+from hypothesis import given, strategies as st
+
+from . import base62
+
+
+@given(st.integers(min_value=0, max_value=2**8000))
+def test_encode(value: int):
+    encoded = base62.encode(value)
+    assert encoded == pybase62.encode(value)
+    assert base62.decode(encoded) == value
+
+
+@given(st.binary(max_size=2000))
+def test_encodebytes(data: bytes):
+    encoded = base62.encodebytes(data)
+    assert encoded == pybase62.encodebytes(data)
+    assert base62.decodebytes(encoded) == data
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"\x00",
+        b"\x00" * 61,
+        b"\x00" * 62,
+        b"\x00" * 200 + b"\x01",
+        b"\xff" * 1000,
+        b"\x00\x00hello",
+    ],
+)
+def test_encodebytes_zeros(data: bytes):
+    encoded = base62.encodebytes(data)
+    assert encoded == pybase62.encodebytes(data)
+    assert base62.decodebytes(encoded) == data
+
+
+@given(st.text("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"))
+def test_decodebytes(encoded: str):
+    assert base62.decodebytes(encoded) == pybase62.decodebytes(encoded)
+
+
+@pytest.mark.parametrize("encoded", ["hello-world", "0-", "a b"])
+def test_decodebytes_invalid(encoded: str):
+    with pytest.raises(ValueError, match="Invalid character"):
+        base62.decodebytes(encoded)
+
+
+def test_type_errors():
+    with pytest.raises(TypeError):
+        base62.encodebytes("hello")  # type: ignore
+    with pytest.raises(TypeError):
+        base62.decodebytes(b"hello")  # type: ignore
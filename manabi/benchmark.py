@@ -0,0 +1,355 @@
+"""Microbenchmarks for the token hot path.
+
+Run with `python -m manabi.benchmark [name ...]`, `--json results.json` writes the
+results and the versions of the dependencies, to compare upgrades.
+"""
+
+import argparse
+import calendar
+import json
+import platform
+import sys
+import timeit
+import tracemalloc
+from datetime import UTC, datetime
+from functools import partial
+from http.cookies import SimpleCookie
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import base62 as pybase62  # type: ignore
+from attr import Factory, dataclass
+from branca import Branca  # type: ignore
+
+from . import base62
+from .auth import ManabiAuthenticator
+from .token import (
+    TTL,
+    Envelope,
+    Key,
+    Token,
+    _decode,
+    _encode,
+    decode_cache,
+    encode_many,
+    now,
+)
+from .type_alias import OptionalProp
+from .util import AppInfo, cattrib, cookie_name, get_cookie, to_string
+
+Setup = Callable[[], Callable[[], Any]]
+
+_key = Key(bytes(range(32)))
+_path = "some/folder/document.docx"
+_paths = [Path(f"some/folder/document-{i}.docx") for i in range(100)]
+_environ: Dict[str, Any] = {}
+_benchmarks: Dict[str, Setup] = {}
+_ttl = TTL(600, 600)
+# Dependencies that affect the results
+_packages = ["WsgiDAV", "pybranca", "pybase62", "attrs", "u-msgpack-python"]
+
+
+def benchmark(setup: Setup) -> Setup:
+    """Register a benchmark, `setup` returns the callable that is timed."""
+    _benchmarks[setup.__name__] = setup
+    return setup
+
+
+@benchmark
+def codec_new() -> Callable[[], Any]:
+    return lambda: Branca(_key.data)
+
+
+@benchmark
+def codec_key() -> Callable[[], Any]:
+    return lambda: _key.branca
+
+
+@benchmark
+def encode_new_codec() -> Callable[[], Any]:
+    return lambda: _encode(_key.data, _path)
+
+
+@benchmark
+def encode_key_codec() -> Callable[[], Any]:
+    return lambda: _encode(_key.branca, _path)
+
+
+_deep_path = "documents/2024/some folder/contract draft.docx"
+_envelope = Envelope({1: "documents/2024/"}, compress=64)
+
+
+@benchmark
+def encode_legacy_envelope() -> Callable[[], Any]:
+    return lambda: _encode(_key.branca, _deep_path)
+
+
+@benchmark
+def encode_compact_envelope() -> Callable[[], Any]:
+    return lambda: _encode(_key.branca, _deep_path, None, None, _envelope)
+
+
+@benchmark
+def as_url_loop_100() -> Callable[[], Any]:
+    return lambda: [Token(_key, path).as_url() for path in _paths]
+
+
+@benchmark
+def encode_many_100() -> Callable[[], Any]:
+    return lambda: encode_many(_key, _paths)
+
+
+@benchmark
+def token_encode() -> Callable[[], Any]:
+    token = Token(_key, Path(_path), {"user": "someone"})
+    return token.encode
+
+
+@benchmark
+def token_from_ciphertext() -> Callable[[], Any]:
+    ciphertext = Token(_key, Path(_path), {"user": "someone"}).encode()
+
+    def decode():
+        decode_cache.clear()
+        return Token.from_ciphertext(_key, ciphertext)
+
+    return decode
+
+
+@benchmark
+def token_from_ciphertext_cached() -> Callable[[], Any]:
+    ciphertext = Token(_key, Path(_path), {"user": "someone"}).encode()
+    return partial(Token.from_ciphertext, _key, ciphertext)
+
+
+@benchmark
+def token_check() -> Callable[[], Any]:
+    token = Token(_key, Path(_path))
+    return partial(token.check, 600)
+
+
+def payload(size: int) -> OptionalProp:
+    """Payload that packs to about `size` bytes."""
+    return {"data": "x" * size} if size else None
+
+
+def encode_payload(size: int) -> Callable[[], Any]:
+    return partial(_encode, _key.branca, _path, payload(size))
+
+
+def decode_payload(size: int) -> Callable[[], Any]:
+    return partial(_decode, _key.branca, _encode(_key.branca, _path, payload(size)))
+
+
+for _size in [0, 100, 1000, 10000]:
+    _benchmarks[f"encode_payload_{_size}"] = partial(encode_payload, _size)
+    _benchmarks[f"decode_payload_{_size}"] = partial(decode_payload, _size)
+
+
+def _stub_app(environ, start_response):
+    start_response("200 OK", [])
+    return [b""]
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def authenticator(cookie: bool) -> Callable[[], Any]:
+    """Return a request through ManabiAuthenticator, with or without cookie."""
+    config = {
+        "manabi": {
+            "key": to_string(_key.data),
+            "refresh": _ttl.refresh,
+            "initial": _ttl.initial,
+        }
+    }
+    auth = ManabiAuthenticator(None, _stub_app, config)
+    token = Token(auth.auth_config.key, Path(_path))
+    url = token.as_url()
+    environ = {"PATH_INFO": f"/{url}", "REMOTE_ADDR": "127.0.0.1"}
+    if cookie:
+        environ["HTTP_COOKIE"] = f"{cookie_name(token.ciphertext)}={token.encode()}"
+
+    def call():
+        return auth(dict(environ), _start_response)
+
+    return call
+
+
+_benchmarks["auth_initial"] = partial(authenticator, False)
+_benchmarks["auth_refresh_cookie"] = partial(authenticator, True)
+
+
+def _cookie_jar(count: int) -> tuple[str, str]:
+    """Cookie header like Office sends it, with `count` refresh cookies."""
+    tokens = [t.partition("/")[0] for t in encode_many(_key, _paths[:count])]
+    cookies = [f"{cookie_name(t)}={t}" for t in tokens]
+    return "; ".join(cookies), cookie_name(tokens[-1])
+
+
+def simple_cookie(count: int) -> Callable[[], Any]:
+    header, name = _cookie_jar(count)
+    return lambda: SimpleCookie(header).get(name)
+
+
+def scan_cookie(count: int) -> Callable[[], Any]:
+    header, name = _cookie_jar(count)
+    return lambda: get_cookie(header, name)
+
+
+for _count in [1, 10, 100]:
+    _benchmarks[f"simple_cookie_{_count}"] = partial(simple_cookie, _count)
+    _benchmarks[f"get_cookie_{_count}"] = partial(scan_cookie, _count)
+
+
+def base62_encode(module: Any, size: int) -> Callable[[], Any]:
+    data = bytes(range(1, 256)) * (size // 255 + 1)
+    return partial(module.encodebytes, data[:size])
+
+
+def base62_decode(module: Any, size: int) -> Callable[[], Any]:
+    encoded = pybase62.encodebytes((bytes(range(1, 256)) * (size // 255 + 1))[:size])
+    return partial(module.decodebytes, encoded)
+
+
+# Typical key, token and a big payload
+for _size in [32, 120, 1000]:
+    for _name, _module in [("pybase62", pybase62), ("base62", base62)]:
+        _benchmarks[f"{_name}_encode_{_size}"] = partial(base62_encode, _module, _size)
+        _benchmarks[f"{_name}_decode_{_size}"] = partial(base62_decode, _module, _size)
+
+
+@benchmark
+def decode_branca() -> Callable[[], Any]:
+    branca = Branca(_key.data)
+    ciphertext = _key.branca.encode(_path)
+    return lambda: (branca.timestamp(ciphertext), branca.decode(ciphertext))
+
+
+@benchmark
+def decode_codec() -> Callable[[], Any]:
+    ciphertext = _key.branca.encode(_path)
+    return partial(_key.branca.decode_timestamp, ciphertext)
+
+
+# Token and AppInfo as they were before they got slots, for comparison
+@dataclass
+class DictToken:
+    key: Key = cattrib(Key)
+    path: Optional[Path] = cattrib(Path, default=None)
+    payload: OptionalProp = cattrib(OptionalProp, default=None)
+    timestamp: Optional[int] = cattrib(
+        int, default=Factory(lambda: now()), optional=True
+    )
+    ciphertext: str = cattrib(str, default=None)
+
+
+@dataclass
+class DictAppInfo:
+    start_response: Callable = cattrib(check=lambda x: callable(x))
+    environ: Dict[str, Any] = cattrib(dict)
+    secure: bool = cattrib(bool, default=True)
+
+
+@benchmark
+def token_dict() -> Callable[[], Any]:
+    return lambda: DictToken(_key, _paths[0], None, 1, "ct")
+
+
+@benchmark
+def token_validated() -> Callable[[], Any]:
+    return lambda: Token(_key, _paths[0], None, 1, "ct")
+
+
+@benchmark
+def token_trusted() -> Callable[[], Any]:
+    return lambda: Token.trusted(_key, _paths[0], None, 1, "ct")
+
+
+@benchmark
+def app_info_dict() -> Callable[[], Any]:
+    return lambda: DictAppInfo(print, _environ, True)
+
+
+@benchmark
+def app_info_validated() -> Callable[[], Any]:
+    return lambda: AppInfo(print, _environ, True)
+
+
+@benchmark
+def app_info_trusted() -> Callable[[], Any]:
+    return lambda: AppInfo.trusted(print, _environ, True)
+
+
+@benchmark
+def clock_timegm() -> Callable[[], Any]:
+    return lambda: calendar.timegm(datetime.now(UTC).timetuple())
+
+
+@benchmark
+def clock_now() -> Callable[[], Any]:
+    return now
+
+
+def allocated(func: Callable[[], Any], number: int) -> float:
+    """Return the bytes per call that are still allocated while the results live."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        results = [func() for _ in range(number)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del results
+    return (after - before) / number
+
+
+def run(
+    names: Optional[List[str]] = None, number: int = 1000, repeat: int = 5
+) -> Dict[str, Dict[str, float]]:
+    """Return the best time per call in microseconds and the allocated bytes.
+
+    Results are keyed by benchmark name.
+    """
+    results = {}
+    for name, setup in _benchmarks.items():
+        if names and name not in names:
+            continue
+        func = setup()
+        best = min(timeit.repeat(func, number=number, repeat=repeat))
+        results[name] = {
+            "usec": best / number * 1e6,
+            "bytes": allocated(func, number),
+        }
+    return results
+
+
+def versions() -> Dict[str, Optional[str]]:
+    result: Dict[str, Optional[str]] = {"python": platform.python_version()}
+    for package in _packages:
+        try:
+            result[package] = version(package)
+        except PackageNotFoundError:
+            result[package] = None
+    return result
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="python -m manabi.benchmark")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, default all")
+    parser.add_argument("--number", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+    results = run(args.names, args.number, args.repeat)
+    for name, result in results.items():
+        print(f"{name:40} {result['usec']:10.2f} us {result['bytes']:10.0f} B")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"versions": versions(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,18 @@
+import json
+
+from .benchmark import _benchmarks, main, run
+
+
+def test_benchmarks_run():
+    results = run(number=1, repeat=1)
+    assert set(results) == set(_benchmarks)
+    assert all(result["usec"] > 0 for result in results.values())
+    assert all(result["bytes"] >= 0 for result in results.values())
+
+
+def test_benchmarks_json(tmp_path):
+    path = tmp_path / "results.json"
+    main(["auth_initial", "token_check", "--number=1", "--repeat=1", f"--json={path}"])
+    data = json.loads(path.read_text())
+    assert set(data["results"]) == {"auth_initial", "token_check"}
+    assert data["versions"]["WsgiDAV"]
@@ -0,0 +1,212 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import IO, Any, Callable, Optional, Tuple, Union
+
+from wsgidav.util import get_module_logger
+
+_logger = get_module_logger(__name__)
+
+# Returns the ETag, the length and the body stream of an object
+Fetch = Callable[[], Tuple[str, int, Any]]
+# Temporary files of other processes might still be filling
+_stale_tmp = 3600
+
+
+class BodyCache:
+    """Bodies of S3 objects on the local disk, keyed by bucket, key and ETag.
+
+    An object changed by another writer gets a new ETag and therefore a new entry,
+    so a body is never served for the wrong ETag. The least recently used bodies are
+    removed when the cache grows above `max_bytes`. The index is per process,
+    bodies cached by other processes sharing `directory` are found after a restart.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._index: OrderedDict = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _scan(self) -> None:
+        entries = []
+        stale = time.time() - _stale_tmp
+        for path in self.directory.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.suffix == ".tmp":
+                if stat.st_mtime < stale:
+                    path.unlink(missing_ok=True)
+                continue
+            entries.append((stat.st_mtime, path.name, stat.st_size))
+        entries.sort()
+        with self._lock:
+            for _, name, size in entries:
+                self._index[name] = size
+                self._size += size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and self._index:
+            name, size = self._index.popitem(last=False)
+            self._size -= size
+            (self.directory / name).unlink(missing_ok=True)
+
+    def _forget(self, name: str) -> None:
+        with self._lock:
+            size = self._index.pop(name, None)
+            if size is not None:
+                self._size -= size
+
+    def _add(self, name: str, tmp: Path, size: int) -> None:
+        with self._lock:
+            os.replace(tmp, self.directory / name)
+            self._size += size - self._index.pop(name, 0)
+            self._index[name] = size
+            self._evict()
+
+    @staticmethod
+    def name(bucket: str, key: str, etag: str) -> str:
+        entry = f"{bucket}\0{key}\0{etag}".encode("UTF-8")
+        return hashlib.blake2b(entry, digest_size=20).hexdigest()
+
+    def get(self, bucket: str, key: str, etag: str) -> Optional[IO[bytes]]:
+        """Open the cached body, if there is one.
+
+        Cached bodies are real files, which the server can send efficiently.
+        """
+        name = self.name(bucket, key, etag)
+        path = self.directory / name
+        with self._lock:
+            if name not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(name)
+        try:
+            f = path.open("rb")
+        except FileNotFoundError:
+            # Removed by another process
+            self._forget(name)
+            with self._lock:
+                self.misses += 1
+            return None
+        # Keeps the order after a restart
+        os.utime(path)
+        with self._lock:
+            self.hits += 1
+        return f
+
+    def fill(self, bucket: str, key: str, fetch: Fetch) -> "FillingReader":
+        """Stream the body from `fetch` and cache it meanwhile."""
+        # The object might have changed since the metadata was read, use the ETag
+        # of the body we actually get
+        etag, length, body = fetch()
+        return FillingReader(self, self.name(bucket, key, etag), length, body)
+
+    def open(
+        self, bucket: str, key: str, etag: str, fetch: Fetch
+    ) -> Union[IO[bytes], "FillingReader"]:
+        """Open the cached body, or stream it from `fetch` and cache it meanwhile."""
+        cached = self.get(bucket, key, etag)
+        if cached is not None:
+            return cached
+        return self.fill(bucket, key, fetch)
+
+
+class FillingReader:
+    """Stream a body and copy it into a temporary file of the cache.
+
+    The body is only added to the cache, with an atomic rename, once all `length`
+    bytes were read. Bodies larger than the cache are not copied. The body is a
+    stream, seeking only works to the current position (wsgidav seeks to 0).
+    """
+
+    def __init__(self, cache: BodyCache, name: str, length: int, body: Any):
+        self._cache = cache
+        self._name = name
+        self._length = length
+        self._body = body
+        self._size = 0
+        self._pos = 0
+        fd, tmp = tempfile.mkstemp(dir=cache.directory, suffix=".tmp")
+        self._tmp = Path(tmp)
+        self._file: Optional[IO[bytes]] = os.fdopen(fd, "wb")
+
+    def __enter__(self) -> "FillingReader":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence != io.SEEK_SET or offset != self._pos:
+            raise io.UnsupportedOperation("FillingReader can't seek")
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._body.read(None if size < 0 else size)
+        self._pos += len(data)
+        if self._file is None:
+            return data
+        if self._length > self._cache.max_bytes:
+            self._abort()
+            return data
+        self._file.write(data)
+        self._size += len(data)
+        if self._size == self._length:
+            self._commit()
+        elif size != 0 and not data:
+            # Shorter than announced
+            self._abort()
+        return data
+
+    def _commit(self) -> None:
+        f = self._file
+        if f is None:
+            return
+        self._file = None
+        try:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            self._cache._add(self._name, self._tmp, self._size)
+        except OSError:
+            _logger.exception("Could not add body to the cache")
+            self._tmp.unlink(missing_ok=True)
+
+    def _abort(self) -> None:
+        f = self._file
+        if f is None:
+            return
+        self._file = None
+        f.close()
+        self._tmp.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        self._abort()
+        self._body.close()
@@ -0,0 +1,116 @@
+import io
+import os
+from pathlib import Path
+
+import pytest
+
+from .body_cache import BodyCache
+
+
+class Fetch:
+    def __init__(self, etag: str, data: bytes):
+        self.etag = etag
+        self.data = data
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.etag, len(self.data), io.BytesIO(self.data)
+
+
+def read(f, size: int = 3) -> bytes:
+    with f:
+        return b"".join(iter(lambda: f.read(size), b""))
+
+
+def test_body_cache(tmp_path: Path):
+    cache = BodyCache(tmp_path, 100)
+    fetch = Fetch("e1", b"hello world")
+    assert read(cache.open("b", "k", "e1", fetch)) == b"hello world"
+    f = cache.open("b", "k", "e1", fetch)
+    assert isinstance(f, io.BufferedReader)
+    assert read(f) == b"hello world"
+    assert fetch.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.size == 11
+    # Another writer changed the object
+    fetch = Fetch("e2", b"changed")
+    assert read(cache.open("b", "k", "e2", fetch)) == b"changed"
+    assert fetch.calls == 1
+    assert cache.size == 18
+
+
+def test_body_cache_exact_length(tmp_path: Path):
+    # wsgidav stops reading after content-length bytes
+    cache = BodyCache(tmp_path, 100)
+    fetch = Fetch("e1", b"hello")
+    with cache.open("b", "k", "e1", fetch) as f:
+        assert f.read(5) == b"hello"
+    read(cache.open("b", "k", "e1", fetch))
+    assert fetch.calls == 1
+
+
+def test_body_cache_seek(tmp_path: Path):
+    cache = BodyCache(tmp_path, 100)
+    with cache.open("b", "k", "e1", Fetch("e1", b"hello")) as f:
+        assert f.seek(0) == 0
+        assert f.read(2) == b"he"
+        assert f.tell() == 2
+        f.seek(2)
+        with pytest.raises(io.UnsupportedOperation):
+            f.seek(0)
+
+
+def test_body_cache_partial_read(tmp_path: Path):
+    cache = BodyCache(tmp_path, 100)
+    fetch = Fetch("e1", b"hello world")
+    with cache.open("b", "k", "e1", fetch) as f:
+        f.read(3)
+    assert cache.size == 0
+    assert list(tmp_path.iterdir()) == []
+    read(cache.open("b", "k", "e1", fetch))
+    assert fetch.calls == 2
+
+
+def test_body_cache_changed_during_fetch(tmp_path: Path):
+    cache = BodyCache(tmp_path, 100)
+    # The metadata said e1, but the object changed before the GET
+    fetch = Fetch("e2", b"new")
+    assert read(cache.open("b", "k", "e1", fetch)) == b"new"
+    assert read(cache.open("b", "k", "e2", fetch)) == b"new"
+    assert fetch.calls == 1
+
+
+def test_body_cache_evict(tmp_path: Path):
+    cache = BodyCache(tmp_path, 10)
+    read(cache.open("b", "a", "e", Fetch("e", b"aaaa")))
+    read(cache.open("b", "b", "e", Fetch("e", b"bbbb")))
+    read(cache.open("b", "a", "e", Fetch("e", b"aaaa")))
+    read(cache.open("b", "c", "e", Fetch("e", b"cccc")))
+    assert cache.size == 8
+    fetch = Fetch("e", b"bbbb")
+    read(cache.open("b", "b", "e", fetch))
+    assert fetch.calls == 1
+    # Larger than the cache
+    read(cache.open("b", "d", "e", Fetch("e", b"d" * 11)))
+    assert cache.size <= 10
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_body_cache_restart(tmp_path: Path):
+    cache = BodyCache(tmp_path, 100)
+    read(cache.open("b", "k", "e", Fetch("e", b"hello")))
+    stale = tmp_path / "x.tmp"
+    stale.write_bytes(b"x")
+    os.utime(stale, (0, 0))
+    cache = BodyCache(tmp_path, 100)
+    assert not stale.exists()
+    assert cache.size == 5
+    fetch = Fetch("e", b"hello")
+    assert read(cache.open("b", "k", "e", fetch)) == b"hello"
+    assert fetch.calls == 0
+    # Removed by another process
+    for path in tmp_path.iterdir():
+        path.unlink()
+    assert read(cache.open("b", "k", "e", fetch)) == b"hello"
+    assert fetch.calls == 1
@@ -1,18 +1,36 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import IO, Any, Callable, Dict, Optional, Tuple, Union
 
 from attr import dataclass
 from botocore.exceptions import ClientError
 from smart_open import open as s3_open
-from wsgidav.dav_error import HTTP_FORBIDDEN, DAVError
+from wsgidav.dav_error import HTTP_FORBIDDEN, HTTP_SERVICE_UNAVAILABLE, DAVError
 from wsgidav.dav_provider import DAVCollection, DAVNonCollection
 from wsgidav.fs_dav_provider import FileResource, FilesystemProvider
-from wsgidav.util import join_uri
+from wsgidav.util import get_module_logger, join_uri, obtain_content_ranges
 
-from .token import Token
-from .type_alias import WriteType
-from .util import cattrib, get_boto_client, requests_session
+from .body_cache import BodyCache
+from .journal import Entry, Journal, JournalWriter
+from .token import Keyring, Token
+from .type_alias import WriteInfoType, WriteType
+from .upload import MultipartWriter, UploadBuffers
+from .util import (
+    ContentHash,
+    LRUCache,
+    cattrib,
+    get_boto_client,
+    requests_session,
+)
+
+_logger = get_module_logger(__name__)
 
 
 class ManabiFolderResource(DAVCollection):
@@ -54,16 +72,104 @@ class ManabiFolderResource(DAVCollection):
 @dataclass
 class CallbackHookConfig:
     pre_write_hook: Optional[str] = cattrib(Optional[str], default=None)
-    pre_write_callback: Optional[WriteType] = cattrib(Optional[WriteType], default=None)
+    pre_write_callback: Optional[Union[WriteType, WriteInfoType]] = cattrib(
+        Optional[WriteType], default=None
+    )
     post_write_hook: Optional[str] = cattrib(Optional[str], default=None)
-    post_write_callback: Optional[WriteType] = cattrib(
+    post_write_callback: Optional[Union[WriteType, WriteInfoType]] = cattrib(
         Optional[WriteType], default=None
     )
+    # Hooks get a JSON object and callbacks a WriteInfo, instead of the token
+    write_info: bool = cattrib(bool, default=False)
+
+
+@dataclass
+class WriteInfo:
+    token: Token = cattrib(Token)
+    # Key of the copy of the content before the write, see snapshot_prefix
+    snapshot: Optional[str] = cattrib(str, default=None)
+    # The content after the write, only for post-write
+    etag: Optional[str] = cattrib(str, default=None)
+    size: Optional[int] = cattrib(int, default=None)
+    sha256: Optional[str] = cattrib(str, default=None)
+    # Seconds from the start of the write till it was stored
+    duration: Optional[float] = cattrib(float, default=None)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "token": self.token.encode(),
+            "snapshot": self.snapshot,
+            "etag": self.etag,
+            "size": self.size,
+            "sha256": self.sha256,
+            "duration": self.duration,
+        }
+
+
+def _call_hook(config: CallbackHookConfig, hook: str, info: WriteInfo):
+    session = requests_session()
+    if config.write_info:
+        return session.post(hook, json=info.to_dict())
+    return session.post(hook, data=info.token.encode())
+
+
+def _call_callback(config: CallbackHookConfig, callback: Any, info: WriteInfo):
+    return callback(info if config.write_info else info.token)
+
+
+def _post_write_info(config: Optional[CallbackHookConfig]) -> bool:
+    """Return True if the post-write hooks get a WriteInfo, it needs a hash."""
+    if config is None or not config.write_info:
+        return False
+    return bool(config.post_write_hook or config.post_write_callback)
+
+
+def post_write(config: CallbackHookConfig, info: WriteInfo) -> None:
+    post_hook = config.post_write_hook
+    post_callback = config.post_write_callback
+
+    if post_hook:
+        _call_hook(config, post_hook, info)
+    if post_callback:
+        _call_callback(config, post_callback, info)
+
+
+class HashingWriter:
+    """Pass writes on to `writer`, meanwhile count and hash them for WriteInfo."""
+
+    def __init__(self, writer: Any):
+        self._writer = writer
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.started = time.monotonic()
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self._hash.update(data)
+        self.size += len(data)
+        return self._writer.write(data)
+
+    def writelines(self, lines) -> None:
+        for data in lines:
+            self.write(data)
+
+    def close(self) -> None:
+        self._writer.close()
 
 
 class ManabiFileResourceMixin:
     _token: Token
     _cb_config: Optional[CallbackHookConfig]
+    _writer: Any = None
+    _hashing: Optional[HashingWriter] = None
+    provider: Any
+    get_etag: Callable[[], Optional[str]]
 
     def delete(self):
         raise DAVError(HTTP_FORBIDDEN)
@@ -86,36 +192,113 @@ class ManabiFileResourceMixin:
         ok, token, config = self._get_token_and_config()
         if not ok:
             return
-        post_hook = config.post_write_hook
-        post_callback = config.post_write_callback
-
-        if post_hook:
-            session = requests_session()
-            session.post(post_hook, data=token.encode())
-        if post_callback:
-            post_callback(token)
+        post_write(config, self._write_info())
+
+    def _hash_writes(self, writer: Any) -> Any:
+        """Wrap `writer`, if the post-write hooks get a WriteInfo."""
+        if not _post_write_info(self._cb_config):
+            return writer
+        self._hashing = HashingWriter(writer)
+        return self._hashing
+
+    def _write_info(self) -> WriteInfo:
+        info = WriteInfo(self._token)
+        hashing = self._hashing
+        if hashing is not None:
+            info.etag = self.get_etag()
+            info.size = hashing.size
+            info.sha256 = hashing.sha256
+            info.duration = time.monotonic() - hashing.started
+        return info
 
     def end_write(self, *, with_errors):
-        if not with_errors:
-            self.process_post_write_hooks()
+        if with_errors:
+            return
+        if self._writer is not None and self._writer.skipped:
+            # Identical to the stored content, nothing to version
+            self.provider.count_skipped_write()
+            return
+        self.process_post_write_hooks()
 
-    def process_pre_write_hooks(self):
+    def process_pre_write_hooks(self, snapshot: Optional[str] = None):
         ok, token, config = self._get_token_and_config()
         if not ok:
             return
         pre_hook = config.pre_write_hook
         pre_callback = config.pre_write_callback
+        info = WriteInfo(token, snapshot)
 
         if pre_hook:
-            session = requests_session()
-            res = session.post(pre_hook, data=token.encode())
+            res = _call_hook(config, pre_hook, info)
             if res.status_code != 200:
                 raise DAVError(HTTP_FORBIDDEN)
         if pre_callback:
-            if not pre_callback(token):
+            if not _call_callback(config, pre_callback, info):
                 raise DAVError(HTTP_FORBIDDEN)
 
 
+class FileWriter:
+    """Write to a temporary file, that replaces `path` on close.
+
+    If the body is identical to the file, the file is kept and `skipped` is set.
+    """
+
+    def __init__(self, provider: "ManabiProvider", path: str):
+        self._provider = provider
+        self._path = path
+        self._hash = ContentHash()
+        self.skipped = False
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=".manabi-", suffix=".tmp"
+        )
+        self._tmp = tmp
+        self._file: Optional[IO[bytes]] = os.fdopen(fd, "wb")
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        if self._file is None:
+            raise ValueError("write to closed FileWriter")
+        self._file.write(data)
+        self._hash.update(data)
+        return len(data)
+
+    def writelines(self, lines) -> None:
+        for data in lines:
+            self.write(data)
+
+    def close(self) -> None:
+        f = self._file
+        if f is None:
+            return
+        etag = self._hash.etag
+        if self._provider.file_etag(self._path, self._hash.size) == etag:
+            self.skipped = True
+            self.abort()
+            return
+        self._file = None
+        try:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            shutil.copymode(self._path, self._tmp)
+            os.replace(self._tmp, self._path)
+        except BaseException:
+            f.close()
+            Path(self._tmp).unlink(missing_ok=True)
+            raise
+        self._provider.remember_file_etag(self._path, etag)
+
+    def abort(self) -> None:
+        f = self._file
+        if f is None:
+            return
+        self._file = None
+        f.close()
+        Path(self._tmp).unlink(missing_ok=True)
+
+
 class ManabiFileResource(ManabiFileResourceMixin, FileResource):
     def __init__(
         self,
@@ -131,7 +314,18 @@ class ManabiFileResource(ManabiFileResourceMixin, FileResource):
 
     def begin_write(self, *, content_type=None):
         self.process_pre_write_hooks()
-        return super().begin_write(content_type=content_type)
+        if not self.provider.skip_identical:
+            return self._hash_writes(super().begin_write(content_type=content_type))
+        assert not self.is_collection
+        if self.provider.readonly:
+            raise DAVError(HTTP_FORBIDDEN)
+        self._writer = FileWriter(self.provider, self._file_path)
+        return self._hash_writes(self._writer)
+
+    def end_write(self, *, with_errors):
+        if with_errors and self._writer is not None:
+            self._writer.abort()
+        super().end_write(with_errors=with_errors)
 
 
 class ManabiProvider(FilesystemProvider):
@@ -142,10 +336,46 @@ class ManabiProvider(FilesystemProvider):
         readonly=False,
         fs_opts=None,
         cb_hook_config: Optional[CallbackHookConfig] = None,
+        skip_identical: bool = False,
     ):
         self._cb_hook_config = cb_hook_config
+        self._init_skip_identical(skip_identical)
         super().__init__(root_folder, readonly=readonly, fs_opts=fs_opts)
 
+    def _init_skip_identical(self, skip_identical: bool) -> None:
+        # Autosave often PUTs what is already stored
+        self.skip_identical = skip_identical
+        self.skipped_writes = 0
+        self._skipped_lock = threading.Lock()
+        self._file_etags = LRUCache(1024)
+
+    def count_skipped_write(self) -> None:
+        with self._skipped_lock:
+            self.skipped_writes += 1
+
+    def file_etag(self, path: str, size: int) -> Optional[str]:
+        """Return the MD5 of the file `path`, if it has `size` bytes."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if stat.st_size != size:
+            return None
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        etag = self._file_etags.get(key)
+        if etag is None:
+            content = ContentHash()
+            with open(path, "rb") as f:
+                for data in iter(lambda: f.read(1024**2), b""):
+                    content.update(data)
+            etag = content.etag
+            self._file_etags.set(key, etag)
+        return etag
+
+    def remember_file_etag(self, path: str, etag: str) -> None:
+        stat = os.stat(path)
+        self._file_etags.set((path, stat.st_mtime_ns, stat.st_size), etag)
+
     def get_file_resource(self, path, environ, fp):
         if Path(fp).exists():
             return ManabiFileResource(
@@ -165,6 +395,101 @@ class ManabiProvider(FilesystemProvider):
         return self.get_file_resource(path, environ, fp)
 
 
+def _document_changed(error: ClientError) -> DAVError:
+    """Return the error for a GET of `IfMatch` that failed, or raise `error`."""
+    if error.response["Error"]["Code"] not in ("PreconditionFailed", "412"):
+        raise error
+    return DAVError(HTTP_SERVICE_UNAVAILABLE, "The document changed, please retry")
+
+
+class S3RangeReader:
+    """Read an object from the position of the first seek, with a ranged GET.
+
+    The GET is sent on the first seek or read. If the reader was seeked to `start`,
+    only the bytes up to `end` (inclusive) are requested, otherwise the rest of the
+    object. Without a seek wsgidav ignores the range (If-Range) and sends all of it. The GET only succeeds for the version with `etag`, the headers of the
+    response were computed from its metadata. If the object was replaced,
+    `on_changed` is called and the request fails before any headers are sent.
+    """
+
+    def __init__(
+        self,
+        s3,
+        bucket_name,
+        key,
+        start: int,
+        end: int,
+        etag: str,
+        on_changed: Optional[Callable[[], None]] = None,
+    ):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self._start = start
+        self._end = end
+        self._etag = etag
+        self._on_changed = on_changed
+        self._pos = 0
+        self._seeked = False
+        self._body: Any = None
+
+    def __enter__(self) -> "S3RangeReader":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return self._body is None
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence != 0 or self._body is not None:
+            raise OSError("S3RangeReader can only seek before reading")
+        self._pos = offset
+        self._seeked = True
+        # wsgidav seeks before it starts the response, it can still fail
+        self._body = self._open()
+        return offset
+
+    def tell(self) -> int:
+        return self._pos
+
+    def _open(self):
+        kwargs = {}
+        if self._seeked and self._pos == self._start:
+            kwargs["Range"] = f"bytes={self._start}-{self._end}"
+        elif self._pos:
+            kwargs["Range"] = f"bytes={self._pos}-"
+        try:
+            response = self.s3.get_object(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                IfMatch=f'"{self._etag}"',
+                **kwargs,
+            )
+        except ClientError as e:
+            changed = _document_changed(e)
+            # Bytes of another version must not be sent under this ETag and range
+            if self._on_changed is not None:
+                self._on_changed()
+            raise changed from e
+        return response["Body"]
+
+    def read(self, size: int = -1) -> bytes:
+        if self._body is None:
+            self._body = self._open()
+        data = self._body.read(None if size < 0 else size)
+        self._pos += len(data)
+        return data
+
+    def close(self) -> None:
+        if self._body is not None:
+            self._body.close()
+
+
 class ManabiS3FileResource(ManabiFileResourceMixin, DAVNonCollection):
     def __init__(
         self,
@@ -183,6 +508,9 @@ class ManabiS3FileResource(ManabiFileResourceMixin, DAVNonCollection):
         self._cb_config = cb_hook_config
         self._token = environ["manabi.token"]
         self.path = path
+        self._writer: Optional[Union[MultipartWriter, JournalWriter]] = None
+        # The copy of the old version, see process_pre_write_hooks
+        self._snapshot: Optional[str] = None
 
         # if the files reside in the buckets top-level directory, there is a difference
         # between MinIO and S3. MinIO doesn't use a database as opposed to S3. That's
@@ -193,27 +521,40 @@ class ManabiS3FileResource(ManabiFileResourceMixin, DAVNonCollection):
             file_path = file_path.lstrip("/")
 
         self.file_path = file_path
-        self.file_obj = self.s3.get_object(Bucket=self.bucket_name, Key=self.file_path)
+        # Saves not uploaded yet are read from the journal
+        self.entry: Optional[Entry] = None
+        journal = self.provider.journal
+        if journal is not None:
+            self.entry = journal.pending(file_path)
+        if self.entry is not None:
+            self.metadata = self.entry.metadata
+        else:
+            # Most requests only need the metadata, get_content opens the body
+            self.metadata = self.provider.head_object(self.file_path)
         self.name = Path(self.path).name
 
     def support_etag(self):
         return True
 
+    def support_ranges(self):
+        return True
+
     def get_content_length(self):
-        return self.file_obj["ContentLength"]
+        return self.metadata["ContentLength"]
 
     def get_content_type(self):
-        return self.file_obj["ContentType"]
+        return self.metadata["ContentType"]
 
     def get_creation_date(self):
         # Amazon S3 maintains only the last modified date for each object.
         return self.get_last_modified()
 
     def get_etag(self):
-        return self.file_obj["ETag"].strip('"')
+        return self.metadata["ETag"].strip('"')
 
     def get_last_modified(self):
-        return time.mktime(self.file_obj["LastModified"].timetuple())
+        # LastModified is aware, mktime would interpret it as local time
+        return self.metadata["LastModified"].timestamp()
 
     def get_content(self):
         """Open content as a stream for reading.
@@ -221,26 +562,163 @@ class ManabiS3FileResource(ManabiFileResourceMixin, DAVNonCollection):
         We can't call `super()` here, because we need to use `open` from `smart_open`.
         """
         assert not self.is_collection
+        journal = self.provider.journal
+        if journal is not None and self.entry is not None:
+            try:
+                return journal.open(self.entry)
+            except FileNotFoundError:
+                # Uploaded meanwhile
+                pass
+        cache = self.provider.body_cache
+        etag = self.get_etag()
+        requested = self._requested_range()
+        if cache is not None and requested is None:
+            return cache.open(self.bucket_name, self.file_path, etag, self._get_object)
+        if cache is not None:
+            # Ranges of cached bodies are read from the file
+            cached = cache.get(self.bucket_name, self.file_path, etag)
+            if cached is not None:
+                return cached
+        if requested is not None:
+            # wsgidav seeks to the start, unless it ignores the range (If-Range)
+            start, end = requested
+            return S3RangeReader(
+                self.s3,
+                self.bucket_name,
+                self.file_path,
+                start,
+                end,
+                etag,
+                lambda: self.provider.forget_metadata(self.file_path),
+            )
         return s3_open(
             f"s3://{self.bucket_name}/{self.file_path}",
             "rb",
             transport_params={"client": self.s3},
         )
 
+    def _requested_range(self) -> Optional[Tuple[int, int]]:
+        """Return first and last byte of the range the client asked for, if any."""
+        header = self.environ.get("HTTP_RANGE")
+        if not header:
+            return None
+        try:
+            ranges, _ = obtain_content_ranges(header, self.get_content_length())
+        except Exception:
+            return None
+        if not ranges:
+            return None
+        start, end, _ = ranges[0]
+        return start, end
+
+    def _get_object(self):
+        # The headers of the response were computed from the metadata
+        try:
+            response = self.s3.get_object(
+                Bucket=self.bucket_name,
+                Key=self.file_path,
+                IfMatch=f'"{self.get_etag()}"',
+            )
+        except ClientError as e:
+            changed = _document_changed(e)
+            self.provider.forget_metadata(self.file_path)
+            raise changed from e
+        etag = response["ETag"].strip('"')
+        return etag, response["ContentLength"], response["Body"]
+
     def begin_write(self, *, content_type=None):
         """Open content as a stream for writing.
 
-        We can't call `super()` here, because we need to use `open` from `smart_open`.
+        We can't call `super()` here, the content is uploaded to S3.
         """
         self.process_pre_write_hooks()
         assert not self.is_collection
         if self.provider.readonly:
             raise DAVError(HTTP_FORBIDDEN)
-        return s3_open(
-            f"s3://{self.bucket_name}/{self.file_path}",
-            "wb",
-            transport_params={"client": self.s3},
+        provider = self.provider
+        skip_etag = self._current_etag() if provider.skip_identical else None
+        # Readers must not get the old metadata while the object changes
+        provider.forget_metadata(self.file_path)
+        if provider.journal is not None:
+            self._writer = provider.journal.begin(
+                self.file_path,
+                self._token,
+                skip_etag,
+                content_type or None,
+                sha256=_post_write_info(self._cb_config),
+            )
+            return self._writer
+        self._writer = MultipartWriter(
+            self.s3,
+            self.bucket_name,
+            self.file_path,
+            provider.upload_executor,
+            provider.upload_buffers,
+            part_size=provider.upload_part_size,
+            concurrency=provider.upload_concurrency,
+            skip_etag=skip_etag,
+            content_type=content_type,
         )
+        return self._hash_writes(self._writer)
+
+    def process_pre_write_hooks(self, snapshot: Optional[str] = None):
+        provider = self.provider
+        ok, _, config = self._get_token_and_config()
+        # Only copied if a pre-write hook gets the key
+        if (
+            provider.snapshot_prefix is None
+            or not ok
+            or not config.write_info
+            or not (config.pre_write_hook or config.pre_write_callback)
+        ):
+            return super().process_pre_write_hooks(snapshot)
+        # The hooks get the key of the old version, instead of downloading it
+        self._snapshot = provider.snapshot(self.file_path)
+        try:
+            super().process_pre_write_hooks(self._snapshot)
+        except BaseException:
+            self._delete_snapshot()
+            raise
+
+    def _delete_snapshot(self) -> None:
+        """Delete the snapshot of a write that did not change the object."""
+        snapshot, self._snapshot = self._snapshot, None
+        if snapshot is not None:
+            self.provider.delete_snapshot(snapshot)
+
+    def _current_etag(self) -> str:
+        """Return the ETag of the latest save, as fresh as the metadata cache."""
+        journal = self.provider.journal
+        entry = None if journal is None else journal.pending(self.file_path)
+        if entry is not None:
+            return entry.etag
+        if self.entry is None:
+            # Read for this request
+            metadata = self.metadata
+        else:
+            # Uploaded since, head_object was written through
+            metadata = self.provider.head_object(self.file_path)
+        return metadata["ETag"].strip('"')
+
+    def end_write(self, *, with_errors):
+        writer = self._writer
+        if with_errors:
+            if writer is not None:
+                writer.abort()
+            self.provider.forget_metadata(self.file_path)
+            self._delete_snapshot()
+        elif writer is not None and writer.skipped:
+            # The object did not change
+            self._delete_snapshot()
+        elif isinstance(writer, JournalWriter):
+            if writer.entry is not None:
+                self.entry = writer.entry
+                self.metadata = writer.entry.metadata
+            # The post-write hooks run once the upload is confirmed
+            return
+        else:
+            self.metadata = self.provider.head_object(self.file_path, refresh=True)
+        super().end_write(with_errors=with_errors)
 
 
 class ManabiS3Provider(ManabiProvider):
@@ -255,6 +733,21 @@ class ManabiS3Provider(ManabiProvider):
         readonly=False,
         shadow=None,
         cb_hook_config: Optional[CallbackHookConfig] = None,
+        metadata_ttl: float = 0,
+        metadata_cache_size: int = 1024,
+        body_cache_dir: Optional[str] = None,
+        body_cache_size: int = 1024**3,
+        upload_part_size: int = 8 * 1024**2,
+        upload_concurrency: int = 4,
+        upload_threads: int = 16,
+        upload_memory: int = 256 * 1024**2,
+        upload_disk: Optional[int] = None,
+        upload_spill_dir: Optional[str] = None,
+        write_behind_dir: Optional[str] = None,
+        write_behind_workers: int = 2,
+        write_behind_attempts: int = 10,
+        skip_identical: bool = False,
+        snapshot_prefix: Optional[str] = None,
     ):
         super(FilesystemProvider, self).__init__()
 
@@ -275,6 +768,7 @@ class ManabiS3Provider(ManabiProvider):
             self.shadow_map = {k.lower(): v for k, v in self.shadow_map.items()}
 
         self._cb_hook_config = cb_hook_config
+        self._init_skip_identical(skip_identical)
 
         self.endpoint_url = endpoint_url
         self.aws_access_key_id = aws_access_key_id
@@ -288,6 +782,134 @@ class ManabiS3Provider(ManabiProvider):
             region_name=self.region_name,
         )
         self._file_resource = None
+        # Office sends PROPFIND and HEAD for the same document many times a minute.
+        # Changes not made through this provider are visible after metadata_ttl.
+        self.metadata_cache = LRUCache(
+            metadata_cache_size if metadata_ttl > 0 else 0, ttl=metadata_ttl
+        )
+        # Documents are opened again and again
+        self.body_cache: Optional[BodyCache] = None
+        if body_cache_dir:
+            self.body_cache = BodyCache(Path(body_cache_dir), body_cache_size)
+        # Parts of large documents are uploaded in parallel. upload_concurrency
+        # limits one upload, upload_threads all uploads of the process.
+        self.upload_part_size = upload_part_size
+        self.upload_concurrency = upload_concurrency
+        self.upload_executor = ThreadPoolExecutor(
+            upload_threads, thread_name_prefix="manabi-upload"
+        )
+        # Concurrent saves must not exhaust the memory of the worker
+        self.upload_buffers = UploadBuffers(
+            upload_memory,
+            upload_disk,
+            Path(upload_spill_dir) if upload_spill_dir else None,
+        )
+        # Versions are copied within S3 before a write
+        self.snapshot_prefix = snapshot_prefix
+        # PUT returns once the body is in the journal, it is uploaded afterwards
+        self.journal: Optional[Journal] = None
+        self._keyring: Optional[Keyring] = None
+        if write_behind_dir:
+            self.journal = Journal(
+                Path(write_behind_dir),
+                self._upload_entry,
+                self._uploaded_entry,
+                write_behind_workers,
+                part_size=upload_part_size,
+                attempts=write_behind_attempts,
+            )
+
+    def start_journal(self, keyring: Keyring) -> None:
+        """Upload the saves replayed from the journal.
+
+        `keyring` decodes the tokens of replayed saves for the post-write hooks.
+        """
+        self._keyring = keyring
+        if self.journal is not None:
+            self.journal.start()
+
+    def _upload_entry(self, entry: Entry, body: IO[bytes]) -> None:
+        self._upload(entry.key, body, entry.content_type)
+
+    def _upload(
+        self, key: str, body: IO[bytes], content_type: Optional[str] = None
+    ) -> None:
+        with MultipartWriter(
+            self.s3,
+            self.bucket_name,
+            key,
+            self.upload_executor,
+            self.upload_buffers,
+            part_size=self.upload_part_size,
+            concurrency=self.upload_concurrency,
+            content_type=content_type,
+        ) as writer:
+            writer.writelines(iter(lambda: body.read(1024**2), b""))
+
+    def _uploaded_entry(self, entry: Entry) -> None:
+        metadata = self.head_object(entry.key, refresh=True)
+        config = self._cb_hook_config
+        if config is None:
+            return
+        token = entry.token
+        if token is None and entry.ciphertext and self._keyring is not None:
+            token = Token.from_ciphertext(self._keyring, entry.ciphertext)
+        if token is None or token.path is None:
+            _logger.warning(f"No token to run the post-write hooks of {entry.key}")
+            return
+        info = WriteInfo(
+            token,
+            etag=metadata["ETag"].strip('"'),
+            size=entry.size,
+            sha256=entry.sha256,
+            duration=entry.duration,
+        )
+        post_write(config, info)
+
+    def snapshot(self, key: str) -> str:
+        """Copy the current content of `key` below `snapshot_prefix`.
+
+        Returns the key of the copy, the content does not leave S3.
+        """
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S.%fZ")
+        snapshot = f"{self.snapshot_prefix}{key}/{stamp}"
+        journal = self.journal
+        entry = None if journal is None else journal.pending(key)
+        if journal is not None and entry is not None:
+            # The latest save is not uploaded yet
+            try:
+                with journal.open(entry) as body:
+                    self._upload(snapshot, body, entry.content_type)
+                return snapshot
+            except FileNotFoundError:
+                pass
+        self.s3.copy_object(
+            Bucket=self.bucket_name,
+            Key=snapshot,
+            CopySource={"Bucket": self.bucket_name, "Key": key},
+        )
+        return snapshot
+
+    def delete_snapshot(self, snapshot: str) -> None:
+        try:
+            self.s3.delete_object(Bucket=self.bucket_name, Key=snapshot)
+        except Exception:
+            # Must not hide why the write failed
+            _logger.exception(f"Could not delete the snapshot {snapshot}")
+
+    def head_object(self, key: str, *, refresh: bool = False) -> Dict[str, Any]:
+        """Return the metadata of the object `key`, from the cache if possible."""
+        cache_key = (self.bucket_name, key)
+        if not refresh:
+            metadata = self.metadata_cache.get(cache_key)
+            if metadata is not None:
+                return metadata
+        metadata = self.s3.head_object(Bucket=self.bucket_name, Key=key)
+        self.metadata_cache.set(cache_key, metadata)
+        return metadata
+
+    def forget_metadata(self, key: str) -> None:
+        self.metadata_cache.pop((self.bucket_name, key))
 
     def get_file_resource(self, path, environ, fp):
         try:
@@ -300,6 +922,7 @@ class ManabiS3Provider(ManabiProvider):
                 cb_hook_config=self._cb_hook_config,
             )
         except ClientError as ex:
-            if ex.response["Error"]["Code"] == "NoSuchKey":
+            # HEAD responses have no body, so the code is just the status
+            if ex.response["Error"]["Code"] in ("NoSuchKey", "404"):
                 # File does not exist
                 return None
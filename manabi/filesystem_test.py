@@ -1,12 +1,24 @@
+import hashlib
+import os
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
+from unittest.mock import patch
 
 import pytest
 import requests
+import requests_mock
 from moto import mock_aws
+from wsgidav.dav_error import DAVError
 
 from . import mock
+from .body_cache import BodyCache
 from .conftest import TEST_FILES_DIR
+from .filesystem import CallbackHookConfig, ManabiS3Provider, WriteInfo
+from .journal import Journal
+from .token import Key, Keyring, Token
+from .upload import MIN_PART_SIZE
+from .util import LRUCache, get_rfc1123_time
 
 
 @pytest.mark.parametrize(
@@ -82,6 +94,419 @@ def test_collection_propfind(
     assert res.content == snapshot
 
 
+def s3_resource(config: Dict[str, Any], name: str):
+    provider = config["provider_mapping"]["/"]
+    token = mock.make_token(config, Path(name))
+    environ = {"manabi.token": token, "wsgidav.provider": provider}
+    return provider.get_resource_inst(token.path_as_url(), environ)
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_resource_lazy_body(config: Dict[str, Any], s3_file):
+    data = (TEST_FILES_DIR / "asdf.docx").read_bytes()
+    s3 = config["provider_mapping"]["/"].s3
+    # Only get_content may fetch the body
+    with patch.object(s3, "get_object", side_effect=AssertionError("get_object")):
+        resource = s3_resource(config, "asdf-s3.docx")
+        assert resource.get_content_length() == len(data)
+        assert resource.get_etag()
+        assert resource.get_last_modified()
+        assert s3_resource(config, "nonexistent.docx") is None
+    with resource.get_content() as f:
+        assert f.read() == data
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_metadata_cache(config: Dict[str, Any], s3_file):
+    provider = config["provider_mapping"]["/"]
+    now = [0.0]
+    provider.metadata_cache = LRUCache(16, ttl=10, clock=lambda: now[0])
+    with patch.object(
+        provider.s3, "head_object", wraps=provider.s3.head_object
+    ) as head_object:
+        size = s3_resource(config, "asdf-s3.docx").get_content_length()
+        assert s3_resource(config, "asdf-s3.docx").get_content_length() == size
+        assert head_object.call_count == 1
+        assert (provider.metadata_cache.hits, provider.metadata_cache.misses) == (1, 1)
+        now[0] = 10
+        s3_resource(config, "asdf-s3.docx")
+        assert head_object.call_count == 2
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_metadata_write_through(config: Dict[str, Any], s3_file):
+    provider = config["provider_mapping"]["/"]
+    provider.metadata_cache = LRUCache(16, ttl=10)
+    resource = s3_resource(config, "asdf-s3.docx")
+    etag = resource.get_etag()
+    with resource.begin_write() as f:
+        assert (provider.bucket_name, resource.file_path) not in provider.metadata_cache
+        f.write(b"hello")
+    resource.end_write(with_errors=False)
+    with patch.object(provider.s3, "head_object", side_effect=AssertionError):
+        resource = s3_resource(config, "asdf-s3.docx")
+        assert resource.get_content_length() == 5
+        assert resource.get_etag() != etag
+    with resource.begin_write() as f:
+        f.write(b"hello world")
+    resource.end_write(with_errors=True)
+    assert s3_resource(config, "asdf-s3.docx").get_content_length() == 11
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_multipart_put(config: Dict[str, Any], s3_file):
+    provider = config["provider_mapping"]["/"]
+    provider.upload_part_size = MIN_PART_SIZE
+    data = os.urandom(2 * MIN_PART_SIZE + 10)
+    resource = s3_resource(config, "asdf-s3.docx")
+    f = resource.begin_write()
+    f.writelines(data[i : i + 65536] for i in range(0, len(data), 65536))
+    f.close()
+    resource.end_write(with_errors=False)
+    assert resource.get_content_length() == len(data)
+    with s3_resource(config, "asdf-s3.docx").get_content() as f:
+        assert f.read() == data
+    # The client went away, the document is not changed
+    resource = s3_resource(config, "asdf-s3.docx")
+    f = resource.begin_write()
+    f.write(os.urandom(MIN_PART_SIZE + 10))
+    resource.end_write(with_errors=True)
+    assert s3_resource(config, "asdf-s3.docx").get_content_length() == len(data)
+    uploads = provider.s3.list_multipart_uploads(Bucket=provider.bucket_name)
+    assert uploads.get("Uploads", []) == []
+    assert (provider.upload_buffers.memory, provider.upload_buffers.disk) == (0, 0)
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_write_behind(config: Dict[str, Any], s3_file, tmp_path):
+    provider = config["provider_mapping"]["/"]
+    written: List[Token] = []
+
+    def post_write_callback(token: Token) -> bool:
+        written.append(token)
+        return True
+
+    provider._cb_hook_config = CallbackHookConfig(
+        post_write_callback=post_write_callback
+    )
+
+    def journal():
+        return Journal(tmp_path, provider._upload_entry, provider._uploaded_entry)
+
+    provider.journal = journal()
+    resource = s3_resource(config, "asdf-s3.docx")
+    # Committed to the journal, not uploaded yet
+    with patch.object(Journal, "_schedule"):
+        with resource.begin_write(content_type="text/plain") as f:
+            f.write(b"hello")
+        resource.end_write(with_errors=False)
+    assert written == []
+    assert resource.get_content_type() == "text/plain"
+    s3_head = provider.s3.head_object(
+        Bucket=provider.bucket_name, Key=resource.file_path
+    )
+    assert s3_head["ContentLength"] != 5
+    resource = s3_resource(config, "asdf-s3.docx")
+    assert resource.get_content_length() == 5
+    with resource.get_content() as f:
+        assert f.read() == b"hello"
+    # Restart, the token of the replayed save is decoded for the hooks
+    provider.journal = journal()
+    provider.start_journal(Keyring.from_dictionary(config))
+    assert provider.journal.flush(5)
+    assert [token.path for token in written] == [Path("asdf-s3.docx")]
+    resource = s3_resource(config, "asdf-s3.docx")
+    assert resource.entry is None
+    assert resource.get_content_length() == 5
+    assert resource.get_content_type() == "text/plain"
+    with resource.get_content() as f:
+        assert f.read() == b"hello"
+    assert list(tmp_path.iterdir()) == []
+
+
+def put(resource, data: bytes) -> None:
+    f = resource.begin_write()
+    f.write(data)
+    f.close()
+    resource.end_write(with_errors=False)
+
+
+@pytest.mark.parametrize(
+    ("config", "name"),
+    [(True, "asdf-s3.docx"), (False, "asdf.docx")],
+    indirect=["config"],
+)
+def test_skip_identical(config: Dict[str, Any], s3_file, name):
+    provider = config["provider_mapping"]["/"]
+    provider.skip_identical = True
+    written: List[Token] = []
+
+    def post_write_callback(token: Token) -> bool:
+        written.append(token)
+        return True
+
+    provider._cb_hook_config = CallbackHookConfig(
+        post_write_callback=post_write_callback
+    )
+    put(s3_resource(config, name), b"hello")
+    etag = s3_resource(config, name).get_etag()
+    resource = s3_resource(config, name)
+    if isinstance(provider, ManabiS3Provider):
+        # The metadata read for the request is compared
+        with patch.object(provider.s3, "head_object", side_effect=AssertionError):
+            put(resource, b"hello")
+    else:
+        put(resource, b"hello")
+    assert provider.skipped_writes == 1
+    assert len(written) == 1
+    assert s3_resource(config, name).get_etag() == etag
+    put(s3_resource(config, name), b"hello world")
+    assert provider.skipped_writes == 1
+    assert len(written) == 2
+    with s3_resource(config, name).get_content() as f:
+        assert f.read() == b"hello world"
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_snapshot(config: Dict[str, Any], s3_file, tmp_path):
+    data = (TEST_FILES_DIR / "asdf.docx").read_bytes()
+    provider = config["provider_mapping"]["/"]
+    provider.snapshot_prefix = "versions/"
+    infos: List[WriteInfo] = []
+    allow = [True]
+
+    def pre_write_callback(info: WriteInfo) -> bool:
+        infos.append(info)
+        return allow[0]
+
+    provider._cb_hook_config = CallbackHookConfig(
+        pre_write_callback=pre_write_callback, write_info=True
+    )
+
+    def get(key: Optional[str]) -> bytes:
+        return provider.s3.get_object(Bucket=provider.bucket_name, Key=key)[
+            "Body"
+        ].read()
+
+    resource = s3_resource(config, "asdf-s3.docx")
+    put(resource, b"hello")
+    snapshot = infos[0].snapshot
+    assert snapshot is not None
+    assert snapshot.startswith(f"versions/{resource.file_path}/")
+    assert infos[0].token.path == Path("asdf-s3.docx")
+    assert get(snapshot) == data
+    assert get(resource.file_path) == b"hello"
+    # Rejected writes don't keep a snapshot
+    allow[0] = False
+    with pytest.raises(DAVError):
+        s3_resource(config, "asdf-s3.docx").begin_write()
+    with pytest.raises(provider.s3.exceptions.NoSuchKey):
+        get(infos[1].snapshot)
+    # The latest save is still in the journal
+    allow[0] = True
+    provider.journal = Journal(
+        tmp_path, provider._upload_entry, provider._uploaded_entry
+    )
+    put(s3_resource(config, "asdf-s3.docx"), b"world")
+    put(s3_resource(config, "asdf-s3.docx"), b"again")
+    assert get(infos[-1].snapshot) == b"world"
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_snapshot_dropped(config: Dict[str, Any], s3_file):
+    provider = config["provider_mapping"]["/"]
+    provider.snapshot_prefix = "versions/"
+    provider.skip_identical = True
+    snapshots: List[Optional[str]] = []
+
+    def pre_write_callback(info: WriteInfo) -> bool:
+        snapshots.append(info.snapshot)
+        if len(snapshots) == 1:
+            raise ConnectionError("The API is down")
+        return True
+
+    def versions() -> List[str]:
+        response = provider.s3.list_objects_v2(
+            Bucket=provider.bucket_name, Prefix="versions/"
+        )
+        return [item["Key"] for item in response.get("Contents", [])]
+
+    provider._cb_hook_config = CallbackHookConfig(
+        pre_write_callback=pre_write_callback, write_info=True
+    )
+    # A failing hook
+    with pytest.raises(ConnectionError):
+        s3_resource(config, "asdf-s3.docx").begin_write()
+    assert versions() == []
+    put(s3_resource(config, "asdf-s3.docx"), b"hello")
+    assert versions() == [snapshots[1]]
+    # A skipped write
+    put(s3_resource(config, "asdf-s3.docx"), b"hello")
+    assert provider.skipped_writes == 1
+    assert versions() == [snapshots[1]]
+    # Nobody gets the key without write_info
+    provider._cb_hook_config = CallbackHookConfig(pre_write_callback=lambda token: True)
+    put(s3_resource(config, "asdf-s3.docx"), b"world")
+    assert versions() == [snapshots[1]]
+
+
+@pytest.mark.parametrize(
+    ("config", "name"),
+    [(True, "asdf-s3.docx"), (False, "asdf.docx")],
+    indirect=["config"],
+)
+def test_write_info_hook(config: Dict[str, Any], s3_file, name):
+    provider = config["provider_mapping"]["/"]
+    provider._cb_hook_config = CallbackHookConfig(
+        pre_write_hook="http://127.0.0.1/pre_write_hook",
+        post_write_hook="http://127.0.0.1/post_write_hook",
+        write_info=True,
+    )
+    with requests_mock.Mocker() as m:
+        m.post("http://127.0.0.1/pre_write_hook")
+        m.post("http://127.0.0.1/post_write_hook")
+        put(s3_resource(config, name), b"hello")
+        pre, post = m.request_history
+    assert pre.json()["snapshot"] is None
+    info = post.json()
+    token = Token.from_ciphertext(Key.from_dictionary(config), info["token"])
+    assert token.path == Path(name)
+    assert info["etag"] == s3_resource(config, name).get_etag()
+    assert info["size"] == 5
+    assert info["sha256"] == hashlib.sha256(b"hello").hexdigest()
+    assert info["duration"] >= 0
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_write_behind_info(config: Dict[str, Any], s3_file, tmp_path):
+    provider = config["provider_mapping"]["/"]
+    infos: List[WriteInfo] = []
+
+    def post_write_callback(info: WriteInfo) -> bool:
+        infos.append(info)
+        return True
+
+    provider._cb_hook_config = CallbackHookConfig(
+        post_write_callback=post_write_callback, write_info=True
+    )
+    provider.journal = Journal(
+        tmp_path, provider._upload_entry, provider._uploaded_entry
+    )
+    provider.start_journal(Keyring.from_dictionary(config))
+    put(s3_resource(config, "asdf-s3.docx"), b"hello")
+    assert provider.journal.flush(5)
+    (info,) = infos
+    assert info.etag == hashlib.md5(b"hello").hexdigest()
+    assert info.size == 5
+    assert info.sha256 == hashlib.sha256(b"hello").hexdigest()
+    assert info.duration is not None
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_body_cache(config: Dict[str, Any], s3_file, tmp_path):
+    data = (TEST_FILES_DIR / "asdf.docx").read_bytes()
+    provider = config["provider_mapping"]["/"]
+    provider.body_cache = BodyCache(tmp_path, 10 * len(data))
+    with s3_resource(config, "asdf-s3.docx").get_content() as f:
+        assert f.read(len(data)) == data
+    with patch.object(provider.s3, "get_object", side_effect=AssertionError):
+        with s3_resource(config, "asdf-s3.docx").get_content() as f:
+            assert f.read() == data
+    resource = s3_resource(config, "asdf-s3.docx")
+    with resource.begin_write() as f:
+        f.write(b"hello")
+    resource.end_write(with_errors=False)
+    with s3_resource(config, "asdf-s3.docx").get_content() as f:
+        assert f.read() == b"hello"
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_range(config: Dict[str, Any], s3_file, server):
+    data = (TEST_FILES_DIR / "asdf.docx").read_bytes()
+    s3 = config["provider_mapping"]["/"].s3
+    req = mock.make_req(config, override_path=Path("asdf-s3.docx"))
+    with patch.object(s3, "get_object", wraps=s3.get_object) as get_object:
+        res = requests.get(req, headers={"Range": "bytes=10-19"})
+        assert res.status_code == 206
+        assert res.content == data[10:20]
+        assert get_object.call_args.kwargs["Range"] == "bytes=10-19"
+        res = requests.get(req, headers={"Range": "bytes=-5"})
+        assert res.status_code == 206
+        assert res.content == data[-5:]
+        # The document changed, the client gets all of it
+        res = requests.get(req, headers={"Range": "bytes=10-19", "If-Range": '"x"'})
+        assert res.status_code == 200
+        assert res.content == data
+        assert "Range" not in get_object.call_args.kwargs
+        # Also if the ignored range starts at the beginning
+        res = requests.get(req, headers={"Range": "bytes=0-9", "If-Range": '"x"'})
+        assert res.status_code == 200
+        assert res.content == data
+        assert "Range" not in get_object.call_args.kwargs
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_body_cache_server(config: Dict[str, Any], s3_file, server, tmp_path):
+    data = (TEST_FILES_DIR / "asdf.docx").read_bytes()
+    provider = config["provider_mapping"]["/"]
+    provider.body_cache = BodyCache(tmp_path, 10 * len(data))
+    req = mock.make_req(config, override_path=Path("asdf-s3.docx"))
+    for _ in range(2):
+        res = requests.get(req)
+        assert res.status_code == 200
+        assert res.content == data
+    assert (provider.body_cache.hits, provider.body_cache.misses) == (1, 1)
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_range_changed(config: Dict[str, Any], s3_file, server):
+    provider = config["provider_mapping"]["/"]
+    provider.metadata_cache = LRUCache(16, ttl=10)
+    req = mock.make_req(config, override_path=Path("asdf-s3.docx"))
+    assert requests.get(req, headers={"Range": "bytes=0-1"}).status_code == 206
+    key = s3_resource(config, "asdf-s3.docx").file_path
+    provider.s3.put_object(Bucket=provider.bucket_name, Key=key, Body=b"new")
+    # The cached metadata is outdated, no bytes of the new version are sent
+    res = requests.get(req, headers={"Range": "bytes=0-1"})
+    assert res.status_code == 503
+    res = requests.get(req, headers={"Range": "bytes=0-1"})
+    assert res.status_code == 206
+    assert res.content == b"ne"
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_body_cache_changed(config: Dict[str, Any], s3_file, server, tmp_path):
+    provider = config["provider_mapping"]["/"]
+    provider.metadata_cache = LRUCache(16, ttl=10)
+    provider.body_cache = BodyCache(tmp_path, 1024**2)
+    req = mock.make_req(config, override_path=Path("asdf-s3.docx"))
+    assert requests.head(req).status_code == 200
+    key = s3_resource(config, "asdf-s3.docx").file_path
+    provider.s3.put_object(Bucket=provider.bucket_name, Key=key, Body=b"new")
+    # The cached metadata is outdated, the new body is not sent under it
+    assert requests.get(req).status_code == 503
+    res = requests.get(req)
+    assert res.status_code == 200
+    assert res.content == b"new"
+    assert res.headers["Content-Length"] == "3"
+
+
+@pytest.mark.parametrize("config", [True], indirect=["config"])
+def test_s3_not_modified(config: Dict[str, Any], s3_file, server):
+    s3 = config["provider_mapping"]["/"].s3
+    req = mock.make_req(config, override_path=Path("asdf-s3.docx"))
+    res = requests.get(req)
+    etag = res.headers["ETag"]
+    modified = parsedate_to_datetime(res.headers["Last-Modified"]).timestamp()
+    with patch.object(s3, "get_object", side_effect=AssertionError("get_object")):
+        res = requests.get(req, headers={"If-None-Match": etag})
+        assert res.status_code == 304
+        # wsgidav only answers 304 to dates after Last-Modified
+        later = get_rfc1123_time(modified + 1)
+        res = requests.get(req, headers={"If-Modified-Since": later})
+        assert res.status_code == 304
+
+
 @pytest.mark.skip(reason="Integration test. Useful in dev with minIO")
 @pytest.mark.parametrize("config", [True], indirect=["config"])  # use S3
 @pytest.mark.parametrize("expect_status", [204])
@@ -0,0 +1,407 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import IO, Any, Callable, Dict, List, Optional, Set, Tuple
+
+from attr import dataclass
+from wsgidav.util import get_module_logger
+
+from .token import Token
+from .util import ContentHash, cattrib
+
+_logger = get_module_logger(__name__)
+
+# Longest pause between retries of a failed upload
+_max_retry = 60
+
+
+@dataclass
+class Entry:
+    """A save committed to the journal, but maybe not yet uploaded."""
+
+    name: str = cattrib(str)
+    key: str = cattrib(str)
+    size: int = cattrib(int)
+    etag: str = cattrib(str)
+    modified: float = cattrib(float)
+    # The token of the save, replayed entries only know the ciphertext
+    ciphertext: Optional[str] = cattrib(str, default=None)
+    token: Optional[Token] = cattrib(Token, default=None, eq=False, repr=False)
+    sha256: Optional[str] = cattrib(str, default=None)
+    # Seconds from the start of the save till it was committed
+    duration: Optional[float] = cattrib(float, default=None)
+    # The Content-Type of the PUT, S3 stores it with the object
+    content_type: Optional[str] = cattrib(str, default=None)
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        """The entry as returned by head_object."""
+        return {
+            "ContentLength": self.size,
+            "ContentType": self.content_type or "binary/octet-stream",
+            "ETag": f'"{self.etag}"',
+            "LastModified": datetime.fromtimestamp(self.modified, timezone.utc),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "key": self.key,
+                "size": self.size,
+                "etag": self.etag,
+                "modified": self.modified,
+                "ciphertext": self.ciphertext,
+                "sha256": self.sha256,
+                "duration": self.duration,
+                "content_type": self.content_type,
+            }
+        )
+
+    @classmethod
+    def from_json(cls, name: str, data: str) -> "Entry":
+        entry = json.loads(data)
+        return cls(
+            name,
+            entry["key"],
+            entry["size"],
+            entry["etag"],
+            entry["modified"],
+            entry["ciphertext"],
+            sha256=entry.get("sha256"),
+            duration=entry.get("duration"),
+            content_type=entry.get("content_type"),
+        )
+
+
+# Upload the body of the entry
+Upload = Callable[[Entry, IO[bytes]], None]
+# Called once the upload is confirmed, before the entry is removed
+Uploaded = Callable[[Entry], None]
+
+
+def _fsync_directory(directory: Path) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_synced(path: Path, data: bytes) -> None:
+    with path.open("wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Journal:
+    """Saves committed to the local disk and uploaded in the background.
+
+    An entry is a body file and a JSON file, the rename of the JSON file commits
+    it. Saves are uploaded as soon as they are committed, saves of the same key in
+    order, a save that was superseded before its upload started is not uploaded.
+    Failed uploads are retried up to `attempts` times, a timer schedules the retry,
+    so the workers meanwhile upload other keys. Then the entry and the saves it
+    superseded are moved to `failed` in `directory`. Entries found in `directory`
+    are replayed by `start`.
+
+    ETags of entries are computed like S3 does for uploads in parts of `part_size`.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        upload: Upload,
+        uploaded: Uploaded,
+        workers: int = 2,
+        retry: float = 1.0,
+        part_size: Optional[int] = None,
+        attempts: int = 10,
+    ):
+        if attempts < 1:
+            raise ValueError("attempts must be at least 1")
+        self.directory = Path(directory)
+        self.failed = self.directory / "failed"
+        self.part_size = part_size
+        self._upload = upload
+        self._uploaded = uploaded
+        self.retry = retry
+        self.attempts = attempts
+        self._executor = ThreadPoolExecutor(
+            workers, thread_name_prefix="manabi-write-behind"
+        )
+        self._pending: Dict[str, List[Entry]] = {}
+        self._active: Set[str] = set()
+        # Failed entry, attempts and delay of the next retry, per key
+        self._failures: Dict[str, Tuple[Entry, int, float]] = {}
+        self._timers: Dict[str, threading.Timer] = {}
+        self._closed = False
+        self._changed = threading.Condition()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    def _scan(self) -> None:
+        committed = set()
+        for path in sorted(self.directory.glob("*.json")):
+            name = path.stem
+            try:
+                entry = Entry.from_json(name, path.read_text(encoding="UTF-8"))
+            except (OSError, ValueError, KeyError, TypeError):
+                _logger.exception(f"Could not read the journal entry {path}")
+                continue
+            committed.add(name)
+            self._pending.setdefault(entry.key, []).append(entry)
+        for path in self.directory.iterdir():
+            # Saves interrupted before they were committed
+            if path.is_file() and path.suffix != ".json" and path.stem not in committed:
+                path.unlink(missing_ok=True)
+        if committed:
+            _logger.warning(
+                f"{len(committed)} saves in {self.directory} are uploaded once the "
+                "journal is started"
+            )
+
+    @property
+    def pending_count(self) -> int:
+        with self._changed:
+            return sum(len(entries) for entries in self._pending.values())
+
+    def pending(self, key: str) -> Optional[Entry]:
+        """Return the latest save of `key` that is not uploaded yet."""
+        with self._changed:
+            entries = self._pending.get(key)
+            return entries[-1] if entries else None
+
+    def body(self, entry: Entry) -> Path:
+        return self.directory / f"{entry.name}.body"
+
+    def open(self, entry: Entry) -> IO[bytes]:
+        """Open the body, raises FileNotFoundError once it was uploaded."""
+        return self.body(entry).open("rb")
+
+    def begin(
+        self,
+        key: str,
+        token: Optional[Token] = None,
+        skip_etag: Optional[str] = None,
+        content_type: Optional[str] = None,
+        *,
+        sha256: bool = False,
+    ) -> "JournalWriter":
+        return JournalWriter(self, key, token, skip_etag, content_type, sha256=sha256)
+
+    def _commit(self, entry: Entry, tmp: Path) -> None:
+        os.replace(tmp, self.body(entry))
+        meta = self.directory / f"{entry.name}.json"
+        meta_tmp = meta.with_suffix(".json.tmp")
+        _write_synced(meta_tmp, entry.to_json().encode("UTF-8"))
+        os.replace(meta_tmp, meta)
+        _fsync_directory(self.directory)
+        with self._changed:
+            self._pending.setdefault(entry.key, []).append(entry)
+            self._schedule(entry.key)
+
+    def _remove(self, entry: Entry) -> None:
+        (self.directory / f"{entry.name}.json").unlink(missing_ok=True)
+        self.body(entry).unlink(missing_ok=True)
+
+    def _set_aside(self, entry: Entry) -> None:
+        self.failed.mkdir(exist_ok=True)
+        for path in (self.body(entry), self.directory / f"{entry.name}.json"):
+            if path.exists():
+                os.replace(path, self.failed / path.name)
+
+    def start(self) -> None:
+        """Upload the entries that were replayed."""
+        with self._changed:
+            for key in list(self._pending):
+                self._schedule(key)
+
+    def _schedule(self, key: str) -> None:
+        if key not in self._active:
+            self._active.add(key)
+            self._executor.submit(self._drain, key)
+
+    def _retry_later(self, key: str, delay: float) -> None:
+        # Called with the lock held
+        if self._closed:
+            return
+        timer = threading.Timer(delay, self._resume, (key,))
+        timer.daemon = True
+        self._timers[key] = timer
+        timer.start()
+
+    def _resume(self, key: str) -> None:
+        with self._changed:
+            # None once closed
+            if self._timers.pop(key, None) is not None:
+                self._executor.submit(self._drain, key)
+
+    def _drain(self, key: str) -> None:
+        while True:
+            with self._changed:
+                entries = self._pending.get(key)
+                if not entries:
+                    self._pending.pop(key, None)
+                    self._failures.pop(key, None)
+                    self._active.discard(key)
+                    self._changed.notify_all()
+                    return
+                entry = entries[-1]
+                failed, attempts, retry = self._failures.pop(key, (None, 0, self.retry))
+            if entry is not failed:
+                attempts = 0
+                retry = self.retry
+            finish = self._remove
+            try:
+                with self.open(entry) as f:
+                    self._upload(entry, f)
+            except Exception:
+                attempts += 1
+                if attempts < self.attempts:
+                    _logger.exception(f"Could not upload {key}, retrying in {retry}s")
+                    # The key stays active, newer saves wait for the retry
+                    with self._changed:
+                        self._failures[key] = (
+                            entry,
+                            attempts,
+                            min(retry * 2, _max_retry),
+                        )
+                        self._retry_later(key, retry)
+                    return
+                _logger.exception(
+                    f"Could not upload {key} in {attempts} attempts, "
+                    f"moved {entry.name} to {self.failed}"
+                )
+                finish = self._set_aside
+            else:
+                try:
+                    self._uploaded(entry)
+                except Exception:
+                    _logger.exception(f"Post-write of {key} failed")
+            with self._changed:
+                # Older saves are superseded by this one
+                index = entries.index(entry)
+                done = entries[: index + 1]
+                del entries[: index + 1]
+            for old in done:
+                finish(old)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all saves are uploaded, return False on timeout."""
+        with self._changed:
+            return self._changed.wait_for(lambda: not self._pending, timeout)
+
+    def close(self) -> None:
+        with self._changed:
+            self._closed = True
+            timers = list(self._timers.values())
+            self._timers.clear()
+        for timer in timers:
+            timer.cancel()
+        self._executor.shutdown(wait=True)
+
+
+class JournalWriter:
+    """Write a save to a temporary file, `close` commits it to the journal.
+
+    A body with the ETag `skip_etag` is identical, it is dropped and `skipped` is
+    set. With `sha256` the SHA-256 of the body is stored in the entry.
+    """
+
+    def __init__(
+        self,
+        journal: Journal,
+        key: str,
+        token: Optional[Token],
+        skip_etag: Optional[str] = None,
+        content_type: Optional[str] = None,
+        *,
+        sha256: bool = False,
+    ):
+        self._journal = journal
+        self._key = key
+        self._token = token
+        self._hash = ContentHash(journal.part_size)
+        self._sha256 = hashlib.sha256() if sha256 else None
+        self._started = time.monotonic()
+        self.skip_etag = skip_etag
+        self.content_type = content_type
+        self.skipped = False
+        self.entry: Optional[Entry] = None
+        fd, tmp = tempfile.mkstemp(dir=journal.directory, suffix=".tmp")
+        self._tmp = Path(tmp)
+        self._file: Optional[IO[bytes]] = os.fdopen(fd, "wb")
+
+    def __enter__(self) -> "JournalWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        if self._file is None:
+            raise ValueError("write to closed JournalWriter")
+        self._file.write(data)
+        self._hash.update(data)
+        if self._sha256 is not None:
+            self._sha256.update(data)
+        return len(data)
+
+    def writelines(self, lines) -> None:
+        for data in lines:
+            self.write(data)
+
+    def close(self) -> None:
+        f = self._file
+        if f is None:
+            return
+        if self._hash.etag == self.skip_etag:
+            self.skipped = True
+            self.abort()
+            return
+        self._file = None
+        try:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            token = self._token
+            entry = Entry(
+                f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}",
+                self._key,
+                self._hash.size,
+                self._hash.etag,
+                time.time(),
+                None if token is None else token.ciphertext or token.encode(),
+                token,
+                None if self._sha256 is None else self._sha256.hexdigest(),
+                time.monotonic() - self._started,
+                self.content_type,
+            )
+            self._journal._commit(entry, self._tmp)
+        except BaseException:
+            f.close()
+            self._tmp.unlink(missing_ok=True)
+            raise
+        self.entry = entry
+
+    def abort(self) -> None:
+        f = self._file
+        if f is None:
+            return
+        self._file = None
+        f.close()
+        self._tmp.unlink(missing_ok=True)
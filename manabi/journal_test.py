@@ -0,0 +1,170 @@
+import hashlib
+import threading
+from pathlib import Path
+from typing import List, Optional
+from unittest.mock import patch
+
+from .journal import Entry, Journal
+
+
+class Uploads:
+    def __init__(self, fail: int = 0):
+        self.fail = fail
+        self.bodies: List[bytes] = []
+        self.uploaded: List[Entry] = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def upload(self, entry: Entry, body) -> None:
+        self.gate.wait(5)
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError("S3 is down")
+        self.bodies.append(body.read())
+
+    def journal(self, directory: Path, attempts: int = 10) -> Journal:
+        return Journal(
+            directory, self.upload, self.uploaded.append, retry=0.01, attempts=attempts
+        )
+
+
+def save(
+    journal: Journal, key: str, data: bytes, content_type: Optional[str] = None
+) -> Entry:
+    writer = journal.begin(key, content_type=content_type)
+    writer.writelines([data[:2], data[2:]])
+    writer.close()
+    assert writer.entry is not None
+    return writer.entry
+
+
+def test_journal(tmp_path: Path):
+    uploads = Uploads()
+    uploads.gate.clear()
+    journal = uploads.journal(tmp_path)
+    entry = save(journal, "doc", b"hello", "text/plain")
+    assert entry.size == 5
+    assert entry.etag == "5d41402abc4b2a76b9719d911017c592"
+    assert entry.metadata["ContentType"] == "text/plain"
+    assert journal.pending("doc") == entry
+    with journal.open(entry) as f:
+        assert f.read() == b"hello"
+    # Uploaded without start
+    uploads.gate.set()
+    assert journal.flush(5)
+    assert uploads.bodies == [b"hello"]
+    assert uploads.uploaded == [entry]
+    assert journal.pending("doc") is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_journal_sha256(tmp_path: Path):
+    journal = Uploads().journal(tmp_path)
+    assert save(journal, "doc", b"hello").sha256 is None
+    writer = journal.begin("doc", sha256=True)
+    writer.write(b"hello")
+    writer.close()
+    assert writer.entry is not None
+    assert writer.entry.sha256 == hashlib.sha256(b"hello").hexdigest()
+    assert journal.flush(5)
+
+
+def test_journal_replay(tmp_path: Path):
+    uploads = Uploads()
+    # Interrupted before the upload
+    with patch.object(Journal, "_schedule"):
+        entry = save(uploads.journal(tmp_path), "doc", b"hello", "text/plain")
+    # Interrupted before the commit
+    (tmp_path / "tmp1234.tmp").write_bytes(b"partial")
+    journal = uploads.journal(tmp_path)
+    assert journal.pending("doc") == entry
+    assert entry.content_type == "text/plain"
+    assert journal.pending_count == 1
+    assert len(list(tmp_path.iterdir())) == 2
+    # Replayed once started
+    assert not journal.flush(0.1)
+    journal.start()
+    assert journal.flush(5)
+    assert uploads.bodies == [b"hello"]
+
+
+def test_journal_retry(tmp_path: Path):
+    uploads = Uploads(fail=2)
+    journal = uploads.journal(tmp_path)
+    journal.start()
+    save(journal, "doc", b"hello")
+    assert journal.flush(5)
+    assert uploads.bodies == [b"hello"]
+    assert len(uploads.uploaded) == 1
+
+
+def test_journal_attempts(tmp_path: Path):
+    uploads = Uploads(fail=100)
+    uploads.gate.clear()
+    journal = uploads.journal(tmp_path, attempts=3)
+    first = save(journal, "doc", b"first")
+    last = save(journal, "doc", b"last")
+    uploads.gate.set()
+    assert journal.flush(5)
+    assert uploads.bodies == []
+    assert uploads.uploaded == []
+    # Kept for the operator, the superseded save as well
+    assert sorted(path.name for path in journal.failed.iterdir()) == [
+        f"{entry.name}.{suffix}"
+        for entry in (first, last)
+        for suffix in ("body", "json")
+    ]
+    # The next save is uploaded
+    uploads.fail = 0
+    save(journal, "doc", b"next")
+    assert journal.flush(5)
+    assert uploads.bodies == [b"next"]
+    assert [path.name for path in tmp_path.iterdir()] == ["failed"]
+    assert uploads.journal(tmp_path).pending_count == 0
+
+
+def test_journal_retry_later(tmp_path: Path):
+    uploaded = threading.Event()
+
+    def upload(entry: Entry, body) -> None:
+        if entry.key == "bad":
+            raise ConnectionError("Access denied")
+        uploaded.set()
+
+    journal = Journal(tmp_path, upload, lambda entry: None, workers=1, retry=60)
+    save(journal, "bad", b"hello")
+    # The only worker doesn't wait for the retry of the other key
+    save(journal, "good", b"hello")
+    assert uploaded.wait(5)
+    assert journal.pending("bad") is not None
+    journal.close()
+
+
+def test_journal_superseded(tmp_path: Path):
+    uploads = Uploads()
+    uploads.gate.clear()
+    journal = uploads.journal(tmp_path)
+    journal.start()
+    save(journal, "doc", b"first")
+    save(journal, "doc", b"second")
+    last = save(journal, "doc", b"third")
+    save(journal, "other", b"other")
+    assert journal.pending("doc") == last
+    uploads.gate.set()
+    assert journal.flush(5)
+    assert uploads.bodies.count(b"third") == 1
+    assert b"second" not in uploads.bodies
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_journal_skip_identical(tmp_path: Path):
+    uploads = Uploads()
+    journal = uploads.journal(tmp_path)
+    entry = save(journal, "doc", b"hello")
+    writer = journal.begin("doc", skip_etag=entry.etag)
+    writer.write(b"hello")
+    writer.close()
+    assert writer.skipped
+    assert writer.entry is None
+    assert journal.pending_count == 1
+    assert len(list(tmp_path.iterdir())) == 2
@@ -106,7 +106,7 @@ def get_config(server_dir: Path, lock_storage: Union[Path, str], use_s3: bool =
         post_write_callback=_post_write_callback,
     )
     provider_class: type[Union[ManabiProvider, ManabiS3Provider]] = ManabiProvider
-    provider_kwargs: dict[str, str] = {}
+    provider_kwargs: dict[str, Any] = {}
     if use_s3:
         provider_class = ManabiS3Provider
         provider_kwargs = {
@@ -0,0 +1,194 @@
+import hashlib
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from psycopg import connect
+from wsgidav.util import get_module_logger
+
+from .util import LRUCache
+
+_logger = get_module_logger(__name__)
+
+
+class BloomFilter:
+    """Set membership with false positives, but no false negatives.
+
+    Sized for `capacity` items at a false positive rate of `error_rate`.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(capacity, 1)
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = max(int(math.ceil(bits)), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _indexes(self, item: str) -> Iterable[int]:
+        # Double hashing, two 64bit hashes give all indexes
+        digest = hashlib.blake2b(item.encode("UTF-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        size = self.size
+        return ((first + i * second) % size for i in range(self.hashes))
+
+    def add(self, item: str) -> None:
+        bits = self._bits
+        for index in self._indexes(item):
+            bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        for index in self._indexes(item):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    @classmethod
+    def from_items(cls, items: list, error_rate: float = 0.001) -> "BloomFilter":
+        bloom = cls(len(items), error_rate)
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+
+class RevocationStore(ABC):
+    """Revoked tokens, as they appear in the URL.
+
+    Requests check an in-memory Bloom filter, that is rebuilt from `load` every
+    `interval` seconds. Only hits of the filter are confirmed by `contains`, which
+    reads the exact list.
+
+    The store fails closed: until the first `load` succeeded every token is checked
+    with `contains`, and a token that can't be checked counts as revoked.
+    """
+
+    def __init__(
+        self,
+        interval: float = 60,
+        error_rate: float = 0.001,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.interval = interval
+        self.error_rate = error_rate
+        self._clock = clock
+        self._bloom: Optional[BloomFilter] = None
+        self._loaded = -math.inf
+        self._reload_lock = threading.Lock()
+        # Confirmed lookups, cleared on reload
+        self._confirmed = LRUCache(1024)
+
+    @abstractmethod
+    def load(self) -> list:
+        pass
+
+    @abstractmethod
+    def contains(self, token: str) -> bool:
+        pass
+
+    def reload(self) -> None:
+        try:
+            bloom = BloomFilter.from_items(self.load(), self.error_rate)
+        except Exception:
+            # Keep the old filter, we try again after the interval
+            _logger.exception("Could not load the revoked tokens")
+        else:
+            self._bloom = bloom
+            self._confirmed.clear()
+        self._loaded = self._clock()
+
+    def maybe_reload(self) -> None:
+        if self._clock() - self._loaded < self.interval:
+            return
+        # The first load blocks, later only one thread reloads and the others use
+        # the old filter meanwhile
+        if not self._reload_lock.acquire(blocking=self._bloom is None):
+            return
+        try:
+            if self._clock() - self._loaded >= self.interval:
+                self.reload()
+        finally:
+            self._reload_lock.release()
+
+    def revoked(self, token: str) -> bool:
+        self.maybe_reload()
+        bloom = self._bloom
+        # Without a filter, the exact list is the only way to know
+        if bloom is not None and token not in bloom:
+            return False
+        confirmed = self._confirmed.get(token)
+        if confirmed is None:
+            try:
+                confirmed = self.contains(token)
+            except Exception:
+                # The filter says it is probably revoked, or there is no filter
+                _logger.exception("Could not check the revoked tokens")
+                return True
+            self._confirmed.set(token, confirmed)
+        return confirmed
+
+    @classmethod
+    def from_dictionary(cls, config: dict) -> Optional["RevocationStore"]:
+        manabi = config["manabi"]
+        interval = manabi.get("revoked_reload", 60)
+        if manabi.get("revoked_file"):
+            return FileRevocationStore(Path(manabi["revoked_file"]), interval)
+        if manabi.get("revoked_dsn"):
+            return PostgresRevocationStore(manabi["revoked_dsn"], interval)
+        return None
+
+
+class FileRevocationStore(RevocationStore):
+    """Revoked tokens, one per line."""
+
+    def __init__(self, path: Path, interval: float = 60, **kwargs):
+        super().__init__(interval, **kwargs)
+        self.path = path
+
+    def _lines(self) -> Iterable[str]:
+        with self.path.open("r", encoding="UTF-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+    def load(self) -> list:
+        if not self.path.exists():
+            return []
+        return list(self._lines())
+
+    def contains(self, token: str) -> bool:
+        if not self.path.exists():
+            return False
+        return any(line == token for line in self._lines())
+
+
+class PostgresRevocationStore(RevocationStore):
+    """Revoked tokens in the table manabi_revoked."""
+
+    def __init__(self, postgres_dsn: str, interval: float = 60, **kwargs):
+        super().__init__(interval, **kwargs)
+        self._postgres_dsn = postgres_dsn
+
+    def load(self) -> list:
+        with connect(self._postgres_dsn) as connection:
+            cursor = connection.execute("SELECT token FROM manabi_revoked")
+            return [row[0] for row in cursor.fetchall()]
+
+    def contains(self, token: str) -> bool:
+        with connect(self._postgres_dsn) as connection:
+            cursor = connection.execute(
+                "SELECT 1 FROM manabi_revoked WHERE token = %s", (token,)
+            )
+            return cursor.fetchone() is not None
+
+    def revoke(self, token: str) -> None:
+        """Add a token, servers pick it up on their next reload."""
+        with connect(self._postgres_dsn) as connection:
+            connection.execute(
+                "INSERT INTO manabi_revoked(token) VALUES (%s) ON CONFLICT DO NOTHING",
+                (token,),
+            )
@@ -0,0 +1,138 @@
+from pathlib import Path
+from typing import List, Optional
+
+import pytest
+from hypothesis import given, strategies as st
+from psycopg import connect
+
+from .revocation import (
+    BloomFilter,
+    FileRevocationStore,
+    PostgresRevocationStore,
+    RevocationStore,
+)
+
+
+@given(st.lists(st.text(), max_size=100))
+def test_bloom_no_false_negatives(items: List[str]):
+    bloom = BloomFilter.from_items(items)
+    for item in items:
+        assert item in bloom
+
+
+def test_bloom_error_rate():
+    bloom = BloomFilter.from_items([f"token{i}" for i in range(1000)], 0.01)
+    false = sum(f"other{i}" in bloom for i in range(10000))
+    assert false < 300
+    assert "anything" not in BloomFilter.from_items([])
+
+
+class Clock:
+    time = 0.0
+
+    def __call__(self) -> float:
+        return self.time
+
+
+class CountingStore(FileRevocationStore):
+    loads = 0
+    checks = 0
+
+    def load(self) -> list:
+        self.loads += 1
+        return super().load()
+
+    def contains(self, token: str) -> bool:
+        self.checks += 1
+        return super().contains(token)
+
+
+def test_file_store(tmp_path: Path):
+    clock = Clock()
+    path = tmp_path / "revoked"
+    store = CountingStore(path, 10, clock=clock)
+    assert not store.revoked("a")
+    path.write_text("a\nb\n")
+    assert not store.revoked("a")
+    assert store.loads == 1
+    clock.time = 10
+    assert store.revoked("a")
+    assert store.revoked("a")
+    assert store.revoked("b")
+    assert not store.revoked("c")
+    assert store.loads == 2
+    assert store.checks == 2
+    path.write_text("b\n")
+    clock.time = 20
+    assert not store.revoked("a")
+
+
+def test_store_load_error(tmp_path: Path):
+    clock = Clock()
+    path = tmp_path / "revoked"
+    path.write_text("a\n")
+    store = FileRevocationStore(path, 10, clock=clock)
+    assert store.revoked("a")
+    path.unlink()
+    path.mkdir()
+    clock.time = 10
+    # The old filter is kept, the exact list can't be read either
+    assert store.revoked("a")
+
+
+def test_from_dictionary(tmp_path: Path, postgres_dsn: str):
+    assert RevocationStore.from_dictionary({"manabi": {}}) is None
+    store = RevocationStore.from_dictionary(
+        {"manabi": {"revoked_file": str(tmp_path), "revoked_reload": 5}}
+    )
+    assert isinstance(store, FileRevocationStore)
+    assert store.interval == 5
+    store = RevocationStore.from_dictionary({"manabi": {"revoked_dsn": postgres_dsn}})
+    assert isinstance(store, PostgresRevocationStore)
+
+
+@pytest.fixture
+def revoked_table(postgres_dsn: str):
+    def clean():
+        with connect(postgres_dsn) as connection:
+            connection.execute("DELETE FROM manabi_revoked")
+
+    clean()
+    yield
+    clean()
+
+
+def test_postgres_store(postgres_dsn: str, revoked_table):
+    clock = Clock()
+    store = PostgresRevocationStore(postgres_dsn, 10, clock=clock)
+    assert not store.revoked("a")
+    store.revoke("a")
+    store.revoke("a")
+    assert not store.revoked("a")
+    clock.time = 10
+    assert store.revoked("a")
+    assert not store.revoked("b")
+
+
+class BrokenStore(RevocationStore):
+    def __init__(self, revoked: Optional[List[str]], **kwargs):
+        super().__init__(**kwargs)
+        self.revoked_tokens = revoked
+
+    def load(self) -> list:
+        raise ConnectionError("database down")
+
+    def contains(self, token: str) -> bool:
+        if self.revoked_tokens is None:
+            raise ConnectionError("database down")
+        return token in self.revoked_tokens
+
+
+def test_store_fails_closed():
+    # The first load failed, tokens are checked one by one
+    store = BrokenStore(["a"])
+    assert store.revoked("a")
+    assert not store.revoked("b")
+    # Nothing can be checked
+    store = BrokenStore(None)
+    assert store.revoked("b")
@@ -1,16 +1,25 @@
-import calendar
 import struct
-from datetime import UTC, datetime
+import time
+import zlib
 from enum import Enum
 from pathlib import Path
-from typing import Optional, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 import umsgpack  # type: ignore
-from attr import Factory, dataclass
+from attr import Factory, attrib, dataclass
 from branca import Branca  # type: ignore
 
+# Installed with pybranca
+from xchacha20poly1305 import (  # type: ignore
+    CRYPTO_AEAD_XHCACHA20POLY1305_IETF_NPUBBYTES as NONCE_BYTES,
+    crypto_aead_xchacha20poly1305_ietf_decrypt as decrypt,
+    crypto_aead_xchacha20poly1305_ietf_encrypt as encrypt,
+    generate_nonce,
+)
+
+from . import base62
 from .type_alias import OptionalProp, PropType
-from .util import cattrib, from_string
+from .util import LRUCache, cattrib, from_string
 
 
 class DecodingError(Exception):
@@ -21,11 +30,55 @@ class EncodingError(Exception):
     pass
 
 
+# Decoded tokens by (key, ciphertext). Office sends the same token with every request,
+# caching the decoded path, payload and timestamp saves the decryption. The ttl is
+# still checked on every request, by Token.check.
+decode_cache = LRUCache(1024)
+
+
 def now() -> int:
-    return calendar.timegm(datetime.now(UTC).timetuple())
+    return int(time.time())
 
 
-@dataclass
+class Codec(Branca):
+    """Branca using manabi's base62 codec, which is a lot faster for long tokens.
+
+    The tokens are identical to the ones of Branca. decode_timestamp returns
+    timestamp and payload, so the token is only base62-decoded once.
+    """
+
+    _header = 5 + NONCE_BYTES
+
+    def encode(self, payload: Union[bytes, str], timestamp: Optional[int] = None):
+        if not isinstance(payload, bytes):
+            payload = payload.encode()
+        if timestamp is None:
+            timestamp = now()
+        nonce = generate_nonce() if self._nonce is None else self._nonce
+        header = struct.pack(">BL", self.VERSION, timestamp) + nonce
+        ciphertext = encrypt(payload, header, nonce, self._key)
+        return base62.encodebytes(header + ciphertext)
+
+    def decode_timestamp(self, token: str, ttl: Optional[int] = None):
+        data = base62.decodebytes(token)
+        header = data[: self._header]
+        version, timestamp = struct.unpack(">BL", header[:5])
+        # Implementation should accept only current version.
+        if version != self.VERSION:
+            raise RuntimeError("Invalid token version")
+        payload = decrypt(data[self._header :], header, header[5:], self._key)
+        if ttl is not None and timestamp + ttl < now():
+            raise RuntimeError("Token is expired")
+        return timestamp, payload
+
+    def decode(self, token: str, ttl: Optional[int] = None) -> bytes:
+        return self.decode_timestamp(token, ttl)[1]
+
+    def timestamp(self, token: str) -> int:
+        return struct.unpack(">BL", base62.decodebytes(token)[:5])[1]
+
+
+@dataclass(slots=True)
 class TTL:
     initial: int = cattrib(int)
     refresh: int = cattrib(int)
@@ -37,23 +90,190 @@ class TTL:
         return cls(initial, refresh)
 
 
-@dataclass
+# Legacy tokens are a msgpack (path, payload) array, which starts with 0x92. Compact
+# tokens start with a version byte.
+ENVELOPE_COMPACT = 0x01
+ENVELOPE_DEFLATE = 0x02
+# Integer tags of the compact map, fields that are None are omitted
+TAG_PATH = 0
+TAG_PREFIX = 1
+TAG_PAYLOAD = 2
+
+
+@dataclass(slots=True)
+class Envelope:
+    """Compact token plaintext, selected per key.
+
+    `prefixes` maps ids to path prefixes, the longest matching prefix is replaced by
+    its id in a msgpack map with integer tags. Paths without prefix keep the legacy
+    array, which is shorter than the map. Plaintexts longer than `compress` bytes
+    are deflated, if that makes them shorter. The ids must not change, as long as
+    tokens using them are valid.
+    """
+
+    prefixes: Dict[int, str] = cattrib(dict, default=Factory(dict))
+    compress: int = cattrib(int, lambda x: x >= 0, default=0)
+    _ordered: List[Tuple[int, str]] = attrib(init=False, eq=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self._ordered = sorted(self.prefixes.items(), key=lambda x: -len(x[1]))
+
+    def pack(self, path: str, payload: OptionalProp) -> bytes:
+        for prefix_id, prefix in self._ordered:
+            if path.startswith(prefix):
+                fields: Dict[int, Any] = {
+                    TAG_PREFIX: prefix_id,
+                    TAG_PATH: path[len(prefix) :].encode("UTF-8"),
+                }
+                if payload is not None:
+                    fields[TAG_PAYLOAD] = payload
+                data = umsgpack.packb(fields)
+                version = ENVELOPE_COMPACT
+                break
+        else:
+            data = umsgpack.packb((path.encode("UTF-8"), payload))
+            version = None
+        if self.compress and len(data) > self.compress:
+            # Raw deflate, the AEAD already protects the integrity
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+            deflated = compressor.compress(data) + compressor.flush()
+            if len(deflated) + 1 < len(data):
+                return bytes((ENVELOPE_DEFLATE,)) + deflated
+        if version is None:
+            return data
+        return bytes((version,)) + data
+
+    @classmethod
+    def from_dictionary(cls, config: dict) -> Optional["Envelope"]:
+        manabi = config["manabi"]
+        if not manabi.get("compact_tokens"):
+            return None
+        prefixes = {int(k): v for k, v in manabi.get("path_prefixes", {}).items()}
+        return cls(prefixes, manabi.get("compress_above", 0))
+
+
+def _unpack(data: bytes, envelope: Optional[Envelope]) -> Tuple[bytes, PropType]:
+    """Return path bytes and payload of legacy and compact plaintexts."""
+    version = data[0] if data else None
+    if version == ENVELOPE_DEFLATE:
+        data = zlib.decompress(data[1:], -15)
+    elif version == ENVELOPE_COMPACT:
+        data = data[1:]
+    fields = umsgpack.unpackb(data)
+    if not isinstance(fields, dict):
+        path, payload = fields
+        return path, payload
+    path = fields[TAG_PATH]
+    prefix_id = fields.get(TAG_PREFIX)
+    if prefix_id is not None:
+        if envelope is None or prefix_id not in envelope.prefixes:
+            raise KeyError(f"Unknown path prefix {prefix_id}")
+        path = envelope.prefixes[prefix_id].encode("UTF-8") + path
+    return path, fields.get(TAG_PAYLOAD)
+
+
+def split_key_id(ciphertext: str) -> Tuple[str, str]:
+    """Split `<key-id>.<branca>` into key-id and branca token.
+
+    Tokens without key-id return an empty key-id.
+    """
+    key_id, _, branca = ciphertext.rpartition(".")
+    return key_id, branca
+
+
+def ciphertext_timestamp(ciphertext: str) -> Optional[int]:
+    """Read the timestamp of a token, without decrypting it."""
+    try:
+        data = from_string(split_key_id(ciphertext)[1])
+        return struct.unpack(">L", data[1:5])[0]
+    except (struct.error, ValueError):
+        return None
+
+
+@dataclass(slots=True)
 class Key:
     data: bytes = cattrib(bytes, lambda x: len(x) == 32)
+    # New tokens are prefixed with the id, so the key can be found without trial
+    # decryption. The branca alphabet is base62, so the "." separator is unambiguous.
+    id: str = cattrib(
+        str,
+        lambda x: len(x) <= 8 and x.isascii() and (x == "" or x.isalnum()),
+        default="",
+    )
+    envelope: Optional[Envelope] = cattrib(Envelope, default=None)
+    _branca: Optional[Tuple[bytes, Codec]] = attrib(
+        default=None, init=False, eq=False, repr=False
+    )
+
+    @property
+    def branca(self) -> Codec:
+        """Branca codec for this key, built on first use and reused after."""
+        cached = self._branca
+        if cached is None or cached[0] is not self.data:
+            cached = self._branca = (self.data, Codec(self.data))
+        return cached[1]
+
+    def prefix(self, ciphertext: str) -> str:
+        if self.id:
+            return f"{self.id}.{ciphertext}"
+        return ciphertext
 
     @classmethod
     def from_dictionary(cls, config: dict) -> "Key":
-        return cls(from_string(config["manabi"]["key"]))
+        manabi = config["manabi"]
+        return cls(
+            from_string(manabi["key"]),
+            manabi.get("key_id", ""),
+            Envelope.from_dictionary(config),
+        )
+
+
+@dataclass
+class Keyring:
+    """The primary key encrypts new tokens, retired keys still decrypt old ones."""
+
+    primary: Key = cattrib(Key)
+    retired: List[Key] = cattrib(list, default=Factory(list))
+    _by_id: Dict[str, Key] = attrib(init=False, eq=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self._by_id = {key.id: key for key in self.retired}
+        self._by_id[self.primary.id] = self.primary
+
+    def get(self, key_id: str) -> Optional[Key]:
+        return self._by_id.get(key_id)
+
+    @classmethod
+    def from_dictionary(cls, config: dict) -> "Keyring":
+        keys = config["manabi"].get("keys", {})
+        primary = Key.from_dictionary(config)
+        retired = [
+            Key(from_string(data), key_id, primary.envelope)
+            for key_id, data in keys.items()
+        ]
+        return cls(primary, retired)
 
 
 @dataclass
 class Config:
     key: Key = cattrib(Key)
     ttl: TTL = cattrib(TTL)
+    keyring: Keyring = cattrib(Keyring, default=None)
+
+    def __attrs_post_init__(self):
+        if self.keyring is None:
+            self.keyring = Keyring(self.key)
 
     @classmethod
     def from_dictionary(cls, config: dict) -> "Config":
-        return cls(Key.from_dictionary(config), TTL.from_dictionary(config))
+        keyring = Keyring.from_dictionary(config)
+        return cls(keyring.primary, TTL.from_dictionary(config), keyring)
+
+
+def is_decode_cached(keyring: Keyring, ciphertext: str) -> bool:
+    """Check if the token was decoded successfully before, without decoding it."""
+    key = keyring.get(split_key_id(ciphertext)[0])
+    return key is not None and (key.data, ciphertext) in decode_cache
 
 
 class State(Enum):
@@ -63,7 +283,7 @@ class State(Enum):
     invalid = 4, "the token is not valid, authentication failed"
 
 
-@dataclass
+@dataclass(slots=True)
 class Token:
     key: Key = cattrib(Key)
     path: Optional[Path] = cattrib(Path, default=None)
@@ -87,35 +307,85 @@ class Token:
             raise ValueError("path may not be None")
         if self.timestamp is None:
             self.timestamp = now()
-        self.ciphertext = _encode(
-            self.key.data,
+        ciphertext = _encode(
+            self.key.branca,
             str(self.path),
             self.payload,
             self.timestamp,
+            self.key.envelope,
         )
+        self.ciphertext = self.key.prefix(ciphertext)
         return self.ciphertext
 
     @classmethod
-    def from_token(cls, token: "Token", timestamp: Optional[int] = None) -> "Token":
+    def from_token(
+        cls,
+        token: "Token",
+        timestamp: Optional[int] = None,
+        key: Optional[Key] = None,
+    ) -> "Token":
+        """Copy the token with a new timestamp, optionally encrypted by another key."""
         if timestamp is None:
-            return cls(token.key, token.path, token.payload, now())
+            timestamp = now()
+        if key is None:
+            key = token.key
+        return cls.trusted(key, token.path, token.payload, timestamp)
 
-        return cls(token.key, token.path, token.payload, timestamp)
+    @classmethod
+    def trusted(
+        cls,
+        key: Key,
+        path: Optional[Path],
+        payload: OptionalProp,
+        timestamp: Optional[int],
+        ciphertext: Optional[str] = None,
+    ) -> "Token":
+        """Create a token without running the validators.
+
+        For the request path, where the values come from decoding or from a
+        validated token. Setting attributes later is still validated.
+        """
+        token = object.__new__(cls)
+        setattr_ = object.__setattr__
+        setattr_(token, "key", key)
+        setattr_(token, "path", path)
+        setattr_(token, "payload", payload)
+        setattr_(token, "timestamp", timestamp)
+        setattr_(token, "ciphertext", ciphertext)
+        return token
 
     @classmethod
-    def from_ciphertext(cls, key: Key, ciphertext: str) -> "Token":
+    def from_ciphertext(cls, key: Union[Key, Keyring], ciphertext: str) -> "Token":
         assert ciphertext
-        branca = Branca(key.data)
-        try:
-            timestamp = branca.timestamp(ciphertext)
-        except (struct.error, ValueError):
+        key_id, raw = split_key_id(ciphertext)
+        if isinstance(key, Keyring):
+            keyring = key
+            found = keyring.get(key_id)
+            if found is None:
+                return cls(keyring.primary, None, None)
+            key = found
+        elif key.id != key_id:
             return cls(key, None, None)
+        cache_key = (key.data, ciphertext)
+        cached = decode_cache.get(cache_key)
+        if cached is not None:
+            token_path, token_payload, timestamp = cached
+            return cls.trusted(key, token_path, token_payload, timestamp, ciphertext)
         try:
-            token_path, token_payload = _decode(branca, ciphertext)
+            timestamp, token_path, token_payload = _decode_timestamp(
+                key.branca, raw, envelope=key.envelope
+            )
         except DecodingError:
             # Handle decoding errors by creating a invalid token
-            return cls(key, None, timestamp)
-        return cls(key, token_path, token_payload, timestamp, ciphertext)
+            return cls(key, None, None)
+        decode_cache.set(cache_key, (token_path, token_payload, timestamp))
+        return cls.trusted(key, token_path, token_payload, timestamp, ciphertext)
+
+    def age(self) -> Optional[int]:
+        """Seconds since the token was issued."""
+        if self.timestamp is None:
+            return None
+        return now() - self.timestamp
 
     def check(self, ttl: Optional[int] = None) -> State:
         if self.path is None or self.timestamp is None:
@@ -137,19 +407,45 @@ class Token:
         return self.check(ttl.initial)
 
 
+def encode_many(
+    key: Key,
+    paths: Iterable[Path],
+    payload: OptionalProp = None,
+    timestamp: Optional[int] = None,
+) -> List[str]:
+    """Return the url of a token for each path, like `Token.as_url`.
+
+    All tokens share the payload, the timestamp and the codec of the key. No Token
+    objects are built, so the arguments are not validated per path.
+    """
+    if timestamp is None:
+        timestamp = now()
+    branca = key.branca
+    envelope = key.envelope
+    return [
+        f"{key.prefix(_encode(branca, str(path), payload, timestamp, envelope))}"
+        f"/{path.name}"
+        for path in paths
+    ]
+
+
 def _encode(
-    key: bytes,
+    key: Union[bytes, Branca],
     path: str,
     payload: OptionalProp = None,
     now: Optional[int] = None,
+    envelope: Optional[Envelope] = None,
 ) -> str:
-    f = Branca(key)
+    f = _codec(key)
     try:
         path_bytes = path.encode("UTF-8")
     except Exception as e:
         raise EncodingError("Could not UTF-8 encode the path") from e
     try:
-        p = umsgpack.packb((path_bytes, payload))
+        if envelope is None:
+            p = umsgpack.packb((path_bytes, payload))
+        else:
+            p = envelope.pack(path, payload)
     except Exception as e:
         raise EncodingError("Could not msg-pack the payload") from e
     try:
@@ -159,25 +455,42 @@ def _encode(
     return ciphertext
 
 
+def _codec(key: Union[bytes, Branca]) -> Branca:
+    if isinstance(key, Branca):
+        return key
+    return Codec(key)
+
+
 def _decode(
     key: Union[bytes, Branca],
     ciphertext: str,
     ttl=None,
+    envelope: Optional[Envelope] = None,
 ) -> Tuple[Path, PropType]:
-    if isinstance(key, Branca):
-        f = key
-    else:
-        f = Branca(key)
+    _, path, payload = _decode_timestamp(key, ciphertext, ttl, envelope)
+    return path, payload
+
+
+def _decode_timestamp(
+    key: Union[bytes, Branca],
+    ciphertext: str,
+    ttl=None,
+    envelope: Optional[Envelope] = None,
+) -> Tuple[int, Path, PropType]:
+    f = _codec(key)
     try:
-        token = f.decode(ciphertext, ttl)
+        if isinstance(f, Codec):
+            timestamp, token = f.decode_timestamp(ciphertext, ttl)
+        else:
+            timestamp, token = f.timestamp(ciphertext), f.decode(ciphertext, ttl)
     except Exception as e:
         raise DecodingError("Could not decode the branca token") from e
     try:
-        tpb, token_payload = umsgpack.unpackb(token)
+        tpb, token_payload = _unpack(token, envelope)
     except Exception as e:
         raise DecodingError("Could not msg-unpack the payload") from e
     try:
         token_path = tpb.decode("UTF-8")
     except Exception as e:
         raise DecodingError("Could not UTF-8 decode the path") from e
-    return Path(token_path), token_payload
+    return timestamp, Path(token_path), token_payload
@@ -3,13 +3,32 @@ from os import environ
 from pathlib import Path
 from string import printable
 from subprocess import PIPE, run
+from typing import Optional
+from unittest.mock import patch
 
 import pytest
+import umsgpack  # type: ignore
 from branca import Branca  # type: ignore
 from hypothesis import assume, given, strategies as st
 
-from . import mock
-from .token import TTL, Config, DecodingError, Key, State, Token, _decode, _encode, now
+from . import mock, token as token_module
+from .token import (
+    TTL,
+    Codec,
+    Config,
+    DecodingError,
+    Envelope,
+    Key,
+    Keyring,
+    State,
+    Token,
+    _decode,
+    _encode,
+    _unpack,
+    decode_cache,
+    encode_many,
+    now,
+)
 from .type_alias import OptionalProp
 from .util import from_string
 
@@ -45,6 +64,53 @@ def test_key_validator(config):
         key.data = b"huhu"  # type: ignore
 
 
+def test_key_branca(config):
+    key = Key.from_dictionary(config)
+    branca = key.branca
+    assert key.branca is branca
+    assert key == Key.from_dictionary(config)
+    key.data = bytes(32)
+    assert key.branca is not branca
+
+
+def test_key_id_validator():
+    assert Key(_key, "k2").id == "k2"
+    with pytest.raises(ValueError):  # noqa: PT011
+        Key(_key, "k.2")
+    with pytest.raises(ValueError):  # noqa: PT011
+        Key(_key, "123456789")
+
+
+def test_keyring(config):
+    old = Key.from_dictionary(config)
+    new = Key(bytes(32), "k2")
+    keyring = Keyring(new, [old])
+    old_ct = Token(old, Path("asdf.docx")).encode()
+    new_ct = Token(new, Path("asdf.docx")).encode()
+    assert not old_ct.startswith("k2.")
+    assert new_ct.startswith("k2.")
+    for ct, key in [(old_ct, old), (new_ct, new)]:
+        token = Token.from_ciphertext(keyring, ct)
+        assert token.check() == State.valid
+        assert token.key is key
+    assert Token.from_ciphertext(Keyring(new), old_ct).check() == State.invalid
+    assert Token.from_ciphertext(keyring, f"k3.{new_ct[3:]}").check() == State.invalid
+    assert Token.from_ciphertext(old, new_ct).check() == State.invalid
+    assert Token.from_ciphertext(new, new_ct).check() == State.valid
+
+
+def test_keyring_from_dictionary(config):
+    config["manabi"]["keys"] = {"": config["manabi"]["key"]}
+    config["manabi"]["key"] = _old_key
+    config["manabi"]["key_id"] = "k2"
+    cfg = Config.from_dictionary(config)
+    assert cfg.key == Key(from_string(_old_key), "k2")
+    assert cfg.keyring.primary is cfg.key
+    assert cfg.keyring.get("") == Key(_key)
+    assert cfg.keyring.get("k2") is cfg.key
+    assert cfg.keyring.get("k3") is None
+
+
 def test_ttl_validator(config):
     ttl = TTL.from_dictionary(config)
     assert ttl.initial == 600
@@ -133,6 +199,138 @@ def test_token_creation(config):
     assert token.check(-10) == State.invalid
 
 
+def test_token_decode_cache(config):
+    cfg = Config.from_dictionary(config)
+    ct = Token(cfg.key, Path("asdf.docx"), {"a": 1}).encode()
+    decode_cache.clear()
+    token = Token.from_ciphertext(cfg.key, ct)
+    assert (decode_cache.hits, decode_cache.misses) == (0, 1)
+    with patch(
+        "manabi.token._decode_timestamp", wraps=token_module._decode_timestamp
+    ) as decode:
+        cached = Token.from_ciphertext(cfg.key, ct)
+        decode.assert_not_called()
+        assert (decode_cache.hits, decode_cache.misses) == (1, 1)
+        assert cached == token
+        other = Key(bytes(32))
+        assert Token.from_ciphertext(other, ct).check() == State.invalid
+        assert decode_cache.misses == 2
+        decode.assert_called_once()
+
+
+def test_token_decode_cache_ttl(config):
+    cfg = Config.from_dictionary(config)
+    ct = Token(cfg.key, Path("asdf.docx")).encode()
+    assert Token.from_ciphertext(cfg.key, ct).initial(cfg.ttl) == State.valid
+    with mock.shift_now(1200):
+        token = Token.from_ciphertext(cfg.key, ct)
+        assert token.initial(cfg.ttl) == State.expired
+
+
+def test_token_trusted(config):
+    cfg = Config.from_dictionary(config)
+    path = Path("asdf.docx")
+    token = Token.trusted(cfg.key, path, [1], 1234, "ct")
+    assert token == Token(cfg.key, path, [1], 1234, "ct")
+    with pytest.raises(TypeError):
+        token.path = "asdf.docx"  # type: ignore
+    assert Token.from_token(token, 10).timestamp == 10
+    assert not hasattr(token, "__dict__")
+
+
+def test_encode_many(config):
+    cfg = Config.from_dictionary(config)
+    paths = [Path("asdf.docx"), Path("folder/qwert.docx")]
+    urls = encode_many(cfg.key, paths, {"user": "a"}, 1234)
+    assert [url.rpartition("/")[2] for url in urls] == ["asdf.docx", "qwert.docx"]
+    for url, path in zip(urls, paths, strict=True):
+        token = Token.from_ciphertext(cfg.key, url.partition("/")[0])
+        assert token.path == path
+        assert token.payload == {"user": "a"}
+        assert token.timestamp == 1234
+    assert encode_many(cfg.key, []) == []
+
+
+_envelope = Envelope({1: "documents/2024/", 2: "documents/"}, compress=64)
+
+
+@pytest.mark.parametrize(
+    ("path", "prefix"),
+    [
+        ("documents/2024/a.docx", 1),
+        ("documents/a.docx", 2),
+        ("other/a.docx", None),
+    ],
+)
+def test_envelope_prefix(path: str, prefix: Optional[int]):
+    data = _envelope.pack(path, None)
+    if prefix is None:
+        assert data == umsgpack.packb((path.encode(), None))
+    else:
+        assert data[0] == 1
+        assert umsgpack.unpackb(data[1:])[1] == prefix
+    assert _unpack(data, _envelope) == (path.encode(), None)
+
+
+def test_envelope_compress():
+    payload: OptionalProp = {"user": "someone", "groups": ["group"] * 20}
+    data = _envelope.pack("a.docx", payload)
+    assert data[0] == 2
+    assert _unpack(data, _envelope) == (b"a.docx", payload)
+    assert Envelope().pack("a.docx", payload)[0] == 0x92
+
+
+def test_envelope_unknown_prefix():
+    ct = _encode(_key, "documents/a.docx", None, None, _envelope)
+    assert _decode(_key, ct, None, _envelope) == (Path("documents/a.docx"), None)
+    with pytest.raises(DecodingError):
+        _decode(_key, ct, None, Envelope())
+    with pytest.raises(DecodingError):
+        _decode(_key, ct)
+
+
+def test_envelope_legacy():
+    ct = _encode(_key, "documents/a.docx", [1, 2])
+    assert _decode(_key, ct, None, _envelope) == (Path("documents/a.docx"), [1, 2])
+
+
+def test_envelope_shorter():
+    path = "documents/2024/some folder/contract draft.docx"
+    payload: OptionalProp = {"user": "someone", "groups": ["group"] * 20}
+    legacy = _encode(_key, path, payload)
+    compact = _encode(_key, path, payload, None, _envelope)
+    assert len(compact) < len(legacy) * 0.6
+
+
+@given(st.text(max_size=32), msgpack)
+def test_envelope_roundtrip(path: str, payload: OptionalProp):
+    assert _unpack(_envelope.pack(path, payload), _envelope) == (
+        path.encode(),
+        payload,
+    )
+
+
+def test_envelope_from_dictionary(config):
+    assert Envelope.from_dictionary(config) is None
+    assert Config.from_dictionary(config).key.envelope is None
+    manabi = config["manabi"]
+    manabi["compact_tokens"] = True
+    manabi["path_prefixes"] = {"1": "documents/"}
+    manabi["compress_above"] = 100
+    manabi["keys"] = {"old": manabi["key"]}
+    envelope = Envelope({1: "documents/"}, 100)
+    assert Envelope.from_dictionary(config) == envelope
+    cfg = Config.from_dictionary(config)
+    assert cfg.key.envelope == envelope
+    old = cfg.keyring.get("old")
+    assert old is not None
+    assert old.envelope == envelope
+    token = Token(cfg.key, Path("documents/a.docx"), {"a": 1})
+    token = Token.from_ciphertext(cfg.keyring, token.encode())
+    assert token.path == Path("documents/a.docx")
+    assert token.payload == {"a": 1}
+
+
 def token_roundtrip(tamper: bool, expire: bool, path: str, payload: OptionalProp):
     with mock.with_config() as config:
         key = Config.from_dictionary(config).key.data
@@ -182,11 +380,35 @@ def test_branca_roundtrip(string: bytes):
     assert res == string
 
 
-def other_impl_decode(string: bytes):
+@given(
+    st.binary(max_size=64),
+    st.integers(0, 2**32 - 1),
+    st.binary(min_size=24, max_size=24),
+)
+def test_codec_branca_compatible(string: bytes, timestamp: int, nonce: bytes):
+    branca = Branca(_key)
+    codec = Codec(_key)
+    branca._nonce = codec._nonce = nonce
+    ct = codec.encode(string, timestamp)
+    assert ct == branca.encode(string, timestamp)
+    assert branca.decode(ct) == string
+    assert codec.decode_timestamp(ct) == (timestamp, string)
+    assert codec.timestamp(ct) == branca.timestamp(ct) == timestamp
+
+
+def test_codec_expired():
+    codec = Codec(_key)
+    ct = codec.encode(b"hello", now() - 10)
+    assert codec.decode(ct, 20) == b"hello"
+    with pytest.raises(RuntimeError):
+        codec.decode(ct, 5)
+
+
+def other_impl_decode(string: bytes, codec=Codec):
     with mock.branca_impl():
         with mock.with_config() as config:
             key = config["manabi"]["key"]
-        f = Branca(from_string(key))
+        f = codec(from_string(key))
         ct = f.encode(string)
         proc = run(["cargo", "run", "decode", key, ct], stdout=PIPE, check=True)
         assert from_string(proc.stdout.decode("UTF-8")) == string
@@ -197,8 +419,9 @@ def cargo_build():
 
 
 @pytest.mark.skipif(cargo_build(), reason="needs rustc and cargo")
-def test_other_impl_decode(cargo):
-    other_impl_decode(b"hello world")
+@pytest.mark.parametrize("codec", [Codec, Branca])
+def test_other_impl_decode(cargo, codec):
+    other_impl_decode(b"hello world", codec)
 
 
 # TODO test binary data when branca-rust supports binary data:
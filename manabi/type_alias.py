@@ -1,6 +1,7 @@
 from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple, Union
 
 if TYPE_CHECKING:
+    from .filesystem import WriteInfo
     from .token import Token
 
 try:
@@ -22,3 +23,5 @@ PropType = Union[
 ]
 OptionalProp = Optional[PropType]
 WriteType = Callable[["Token"], bool]
+# Callbacks with CallbackHookConfig.write_info
+WriteInfoType = Callable[["WriteInfo"], bool]
@@ -0,0 +1,351 @@
+import tempfile
+import threading
+from concurrent.futures import Executor, Future, wait
+from pathlib import Path
+from typing import IO, Any, Dict, Iterable, List, Optional, Union
+
+from wsgidav.util import get_module_logger
+
+from .util import ContentHash
+
+_logger = get_module_logger(__name__)
+
+# S3 rejects smaller parts, except for the last one
+MIN_PART_SIZE = 5 * 1024**2
+
+
+class UploadBuffers:
+    """Budget for the parts of all uploads that are buffered at the same time.
+
+    Parts are buffered in memory while `memory_bytes` allows. A part that doesn't
+    fit any more is spilled to a temporary file in `directory`. When `disk_bytes` is
+    exhausted as well, writing waits for full parts to be uploaded, so uploads stop
+    reading from their clients. Parts only take what they hold, so small documents
+    don't use up the budget. If only parts that are still written hold the budget,
+    waiting would never end, the write exceeds `disk_bytes` instead. The gauges
+    `memory` and `disk` count the bytes buffered.
+    """
+
+    def __init__(
+        self,
+        memory_bytes: int = 256 * 1024**2,
+        disk_bytes: Optional[int] = None,
+        directory: Optional[Path] = None,
+    ):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = directory
+        self.memory = 0
+        self.disk = 0
+        # Bytes of full parts, they are released once uploaded
+        self._full = 0
+        # Writes that had to wait
+        self.waits = 0
+        self._changed = threading.Condition()
+
+    def _fits_disk(self, size: int) -> bool:
+        if self.disk_bytes is None or self.disk == 0:
+            return True
+        return self.disk + size <= self.disk_bytes
+
+    def allocate(self, size: int) -> "PartBuffer":
+        """Return an empty buffer for a part of up to `size` bytes."""
+        return PartBuffer(self, size)
+
+    def _grow(self, part: "PartBuffer", size: int) -> bool:
+        """Account `size` more bytes of `part`, True if it has to be spilled."""
+        with self._changed:
+            waited = False
+            while True:
+                # Nothing would release the budget
+                force = self._full == 0
+                if part.spilled:
+                    if force or self._fits_disk(size):
+                        self.disk += size
+                        return False
+                elif self.memory + size <= self.memory_bytes:
+                    self.memory += size
+                    return False
+                elif force or self._fits_disk(len(part) + size):
+                    self.memory -= len(part)
+                    self.disk += len(part) + size
+                    return True
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                self._changed.wait()
+
+    def _unspill(self, part: "PartBuffer", size: int) -> None:
+        with self._changed:
+            self.disk -= len(part) + size
+            self.memory += len(part)
+            self._changed.notify_all()
+
+    def _fill(self, part: "PartBuffer") -> None:
+        with self._changed:
+            self._full += len(part)
+
+    def _release(self, part: "PartBuffer") -> None:
+        with self._changed:
+            if len(part) >= part.size:
+                self._full -= len(part)
+            if part.spilled:
+                self.disk -= len(part)
+            else:
+                self.memory -= len(part)
+            self._changed.notify_all()
+
+
+class PartBuffer:
+    """A part buffered in memory or in a temporary file, see `UploadBuffers`."""
+
+    def __init__(self, buffers: UploadBuffers, size: int):
+        self._buffers = buffers
+        self.size = size
+        self._spill: Optional[IO[bytes]] = None
+        self._memory = bytearray()
+        self._length = 0
+        self.closed = False
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def spilled(self) -> bool:
+        return self._spill is not None
+
+    def _spill_memory(self, size: int) -> None:
+        try:
+            spill = tempfile.TemporaryFile(dir=self._buffers.directory)
+            spill.write(self._memory)
+        except BaseException:
+            self._buffers._unspill(self, size)
+            raise
+        self._spill = spill
+        self._memory = bytearray()
+
+    def write(self, data: Union[bytes, memoryview]) -> None:
+        # Waits while the budget of all uploads is exhausted
+        if self._buffers._grow(self, len(data)):
+            self._spill_memory(len(data))
+        if self._spill is None:
+            self._memory += data
+        else:
+            self._spill.write(data)
+        self._length += len(data)
+        if data and self._length >= self.size:
+            self._buffers._fill(self)
+
+    def body(self) -> Union[bytes, IO[bytes]]:
+        if self._spill is None:
+            return bytes(self._memory)
+        self._spill.flush()
+        self._spill.seek(0)
+        return self._spill
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._buffers._release(self)
+        self._memory = bytearray()
+        if self._spill is not None:
+            self._spill.close()
+
+
+class MultipartWriter:
+    """Upload an object in parts, up to `concurrency` parts at a time.
+
+    Parts are uploaded on `executor` while the next part is received, the executor
+    may be shared with other uploads and limits them all. Writing blocks when
+    `concurrency` parts of this upload are in flight, so it holds at most
+    `(concurrency + 1) * part_size` bytes. The parts are allocated from `buffers`,
+    shared by all uploads. Objects smaller than `part_size` are uploaded with a
+    single PUT. On errors the multipart upload is aborted.
+
+    The object is stored with `content_type`, if given.
+
+    If the body has the ETag `skip_etag`, it is identical to the object and the
+    upload is dropped instead of completed, `skipped` is set.
+    """
+
+    def __init__(
+        self,
+        s3,
+        bucket_name: str,
+        key: str,
+        executor: Executor,
+        buffers: UploadBuffers,
+        *,
+        part_size: int = 8 * 1024**2,
+        concurrency: int = 4,
+        skip_etag: Optional[str] = None,
+        content_type: Optional[str] = None,
+    ):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {MIN_PART_SIZE}")
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self._extra = {"ContentType": content_type} if content_type else {}
+        self.part_size = part_size
+        self._executor = executor
+        self._buffers = buffers
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._part: Optional[PartBuffer] = None
+        self._upload_id: Optional[str] = None
+        self._futures: List[Future] = []
+        self.size = 0
+        self.closed = False
+        self.skip_etag = skip_etag
+        self.skipped = False
+        self._hash = None if skip_etag is None else ContentHash(part_size)
+        # Response of the PUT or of completing the multipart upload
+        self.response: Optional[Dict[str, Any]] = None
+
+    def __enter__(self) -> "MultipartWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        if self.closed:
+            raise ValueError("write to closed MultipartWriter")
+        try:
+            view = memoryview(data)
+            while view:
+                if self._part is None:
+                    self._part = self._buffers.allocate(self.part_size)
+                part = self._part
+                chunk = view[: self.part_size - len(part)]
+                part.write(chunk)
+                if self._hash is not None:
+                    self._hash.update(chunk)
+                self.size += len(chunk)
+                view = view[len(chunk) :]
+                if len(part) == self.part_size:
+                    self._part = None
+                    self._submit(part)
+        except BaseException:
+            self.abort()
+            raise
+        return len(data)
+
+    def writelines(self, lines: Iterable[bytes]) -> None:
+        try:
+            for data in lines:
+                self.write(data)
+        except BaseException:
+            # The client might have gone away
+            self.abort()
+            raise
+
+    def _raise_failed(self) -> None:
+        for future in self._futures:
+            if future.done():
+                exception = future.exception()
+                if exception is not None:
+                    raise exception
+
+    def _submit(self, part: PartBuffer) -> None:
+        try:
+            if self._upload_id is None:
+                response = self.s3.create_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.key, **self._extra
+                )
+                self._upload_id = response["UploadId"]
+            self._raise_failed()
+            # Backpressure, bounds the memory of an upload
+            self._slots.acquire()
+        except BaseException:
+            part.close()
+            raise
+        number = len(self._futures) + 1
+        try:
+            self._raise_failed()
+            future = self._executor.submit(self._upload_part, number, part)
+        except BaseException:
+            part.close()
+            self._slots.release()
+            raise
+
+        def done(_: Future) -> None:
+            # Also runs for parts cancelled before they were uploaded
+            part.close()
+            self._slots.release()
+
+        future.add_done_callback(done)
+        self._futures.append(future)
+
+    def _upload_part(self, number: int, part: PartBuffer) -> Dict[str, Any]:
+        response = self.s3.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=number,
+            Body=part.body(),
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def _close_part(self) -> None:
+        if self._part is not None:
+            self._part.close()
+            self._part = None
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        if self._hash is not None and self._hash.etag == self.skip_etag:
+            self.skipped = True
+            self.abort()
+            return
+        try:
+            if self._upload_id is None:
+                body = b"" if self._part is None else self._part.body()
+                self.response = self.s3.put_object(
+                    Bucket=self.bucket_name, Key=self.key, Body=body, **self._extra
+                )
+                self._close_part()
+            else:
+                if self._part is not None:
+                    part, self._part = self._part, None
+                    self._submit(part)
+                parts = [future.result() for future in self._futures]
+                self.response = self.s3.complete_multipart_upload(
+                    Bucket=self.bucket_name,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+        except BaseException:
+            self.abort()
+            raise
+        self.closed = True
+
+    def abort(self) -> None:
+        """Discard the upload, the object is not changed."""
+        if self.closed:
+            return
+        self.closed = True
+        self._close_part()
+        for future in self._futures:
+            future.cancel()
+        # Parts still uploading would be added to the aborted upload
+        wait(self._futures)
+        if self._upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.key, UploadId=self._upload_id
+                )
+            except Exception:
+                # A lifecycle rule has to clean up
+                _logger.exception(f"Could not abort the upload of {self.key}")
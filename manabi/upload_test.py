@@ -0,0 +1,231 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from .upload import MIN_PART_SIZE, MultipartWriter, UploadBuffers
+from .util import ContentHash
+
+_bucket = os.environ.get("S3_BUCKET_NAME", "manabi-media")
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(4) as executor:
+        yield executor
+
+
+@pytest.fixture
+def buffers():
+    buffers = UploadBuffers()
+    yield buffers
+    assert (buffers.memory, buffers.disk) == (0, 0)
+
+
+def data(size: int) -> bytes:
+    return bytes(range(256)) * (size // 256) + bytes(size % 256)
+
+
+def get(s3, key: str) -> bytes:
+    return s3.get_object(Bucket=_bucket, Key=key)["Body"].read()
+
+
+def pending_uploads(s3) -> list:
+    return s3.list_multipart_uploads(Bucket=_bucket).get("Uploads", [])
+
+
+@pytest.mark.parametrize("size", [0, 100, MIN_PART_SIZE, 2 * MIN_PART_SIZE + 100])
+def test_multipart_writer(s3, executor, buffers, size: int):
+    content = data(size)
+    writer = MultipartWriter(
+        s3, _bucket, "doc", executor, buffers, part_size=MIN_PART_SIZE
+    )
+    writer.writelines(content[i : i + 65536] for i in range(0, size, 65536))
+    writer.close()
+    assert get(s3, "doc") == content
+    assert writer.size == size
+    assert writer.response is not None
+    expected = ContentHash(MIN_PART_SIZE)
+    expected.update(content)
+    assert writer.response["ETag"].strip('"') == expected.etag
+    assert pending_uploads(s3) == []
+
+
+def test_multipart_writer_concurrency(s3, executor, buffers):
+    upload_part = s3.upload_part
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def slow_upload_part(**kwargs):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        try:
+            return upload_part(**kwargs)
+        finally:
+            with lock:
+                running[0] -= 1
+
+    s3.upload_part = slow_upload_part
+    content = data(6 * MIN_PART_SIZE)
+    with MultipartWriter(
+        s3, _bucket, "doc", executor, buffers, part_size=MIN_PART_SIZE, concurrency=2
+    ) as writer:
+        writer.write(content)
+    assert running[1] == 2
+    assert get(s3, "doc") == content
+
+
+def test_multipart_writer_abort(s3, executor, buffers):
+    s3.put_object(Bucket=_bucket, Key="doc", Body=b"old")
+    upload_part = s3.upload_part
+
+    def failing_upload_part(**kwargs):
+        if kwargs["PartNumber"] == 2:
+            raise RuntimeError("network")
+        return upload_part(**kwargs)
+
+    s3.upload_part = failing_upload_part
+    writer = MultipartWriter(
+        s3, _bucket, "doc", executor, buffers, part_size=MIN_PART_SIZE
+    )
+    chunks = [data(MIN_PART_SIZE)] * 4
+    with pytest.raises(RuntimeError, match="network"):
+        with writer:
+            writer.writelines(chunks)
+    assert writer.closed
+    assert get(s3, "doc") == b"old"
+    assert pending_uploads(s3) == []
+
+
+def test_multipart_writer_client_gone(s3, executor, buffers):
+    def stream():
+        yield data(MIN_PART_SIZE + 1)
+        raise ConnectionError("client gone")
+
+    writer = MultipartWriter(
+        s3, _bucket, "doc", executor, buffers, part_size=MIN_PART_SIZE
+    )
+    with pytest.raises(ConnectionError):
+        writer.writelines(stream())
+    assert pending_uploads(s3) == []
+
+
+def test_multipart_writer_part_size(s3, executor, buffers):
+    with pytest.raises(ValueError, match="part_size"):
+        MultipartWriter(s3, _bucket, "doc", executor, buffers, part_size=1024)
+
+
+def test_upload_buffers_spill(s3, executor, tmp_path):
+    buffers = UploadBuffers(MIN_PART_SIZE, directory=tmp_path)
+    upload_part = s3.upload_part
+    gauges = []
+
+    def slow_upload_part(**kwargs):
+        gauges.append((buffers.memory, buffers.disk))
+        time.sleep(0.05)
+        return upload_part(**kwargs)
+
+    s3.upload_part = slow_upload_part
+    content = data(3 * MIN_PART_SIZE + 10)
+    with MultipartWriter(
+        s3, _bucket, "doc", executor, buffers, part_size=MIN_PART_SIZE
+    ) as writer:
+        writer.write(content)
+    assert get(s3, "doc") == content
+    assert max(memory for memory, _ in gauges) <= MIN_PART_SIZE
+    assert max(disk for _, disk in gauges) >= MIN_PART_SIZE
+    assert (buffers.memory, buffers.disk) == (0, 0)
+
+
+def test_upload_buffers_backpressure(tmp_path):
+    buffers = UploadBuffers(10, 10, tmp_path)
+    in_memory = buffers.allocate(10)
+    spilled = buffers.allocate(10)
+    in_memory.write(b"0123456789")
+    spilled.write(b"0123456789")
+    assert (in_memory.spilled, spilled.spilled) == (False, True)
+    assert (buffers.memory, buffers.disk) == (10, 10)
+    waiting = buffers.allocate(10)
+    thread = threading.Thread(target=lambda: waiting.write(b"0123456789"))
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+    assert buffers.waits == 1
+    spilled.close()
+    thread.join(5)
+    assert waiting.spilled
+    waiting.close()
+    in_memory.close()
+    assert (buffers.memory, buffers.disk) == (0, 0)
+    # A part larger than the budget still progresses
+    part = UploadBuffers(0, 0, tmp_path).allocate(10)
+    part.write(b"0123456789")
+    assert part.spilled
+    part.close()
+
+
+def test_upload_buffers_partial_parts(tmp_path):
+    buffers = UploadBuffers(8, 10, tmp_path)
+    parts = [buffers.allocate(100) for _ in range(4)]
+    # No part is full, so none would be uploaded and release the budget
+    threads = [
+        threading.Thread(target=lambda part=part: part.write(b"01234"), daemon=True)
+        for part in parts
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert not any(thread.is_alive() for thread in threads)
+    assert buffers.memory + buffers.disk == 20
+    for part in parts:
+        part.close()
+    assert (buffers.memory, buffers.disk) == (0, 0)
+
+
+def test_upload_buffers_grow(tmp_path):
+    buffers = UploadBuffers(100, 100, tmp_path)
+    parts = [buffers.allocate(MIN_PART_SIZE) for _ in range(10)]
+    for part in parts:
+        part.write(b"0123456789")
+    # Small parts only take what they hold
+    assert not any(part.spilled for part in parts)
+    assert (buffers.memory, buffers.disk) == (100, 0)
+    parts[0].write(b"0123456789")
+    assert parts[0].spilled
+    body = parts[0].body()
+    assert not isinstance(body, bytes)
+    assert body.read() == 2 * b"0123456789"
+    assert (buffers.memory, buffers.disk) == (90, 20)
+    for part in parts:
+        part.close()
+    assert (buffers.memory, buffers.disk) == (0, 0)
+
+
+@pytest.mark.parametrize("size", [100, 2 * MIN_PART_SIZE + 100])
+def test_multipart_writer_skip_identical(s3, executor, buffers, size: int):
+    content = data(size)
+    with MultipartWriter(
+        s3, _bucket, "doc", executor, buffers, part_size=MIN_PART_SIZE
+    ) as writer:
+        writer.write(content)
+    etag = s3.head_object(Bucket=_bucket, Key="doc")["ETag"].strip('"')
+    s3.put_object = s3.complete_multipart_upload = None
+    with MultipartWriter(
+        s3, _bucket, "doc", executor, buffers, part_size=MIN_PART_SIZE, skip_etag=etag
+    ) as writer:
+        writer.write(content)
+    assert writer.skipped
+    assert pending_uploads(s3) == []
+    del s3.put_object, s3.complete_multipart_upload
+    changed = content[:-1] + b"x"
+    with MultipartWriter(
+        s3, _bucket, "doc", executor, buffers, part_size=MIN_PART_SIZE, skip_etag=etag
+    ) as writer:
+        writer.write(changed)
+    assert not writer.skipped
+    assert get(s3, "doc") == changed
@@ -1,20 +1,21 @@
-import calendar
+import hashlib
 import os
 import threading
-from datetime import UTC, datetime
+import time
+from collections import OrderedDict
 from email.utils import formatdate
-from http.cookies import SimpleCookie
 from inspect import getsource
-from typing import Any, Callable, Dict, List, Optional, Tuple, cast
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
-import base62  # type: ignore
 import boto3
 import requests
 from attr import attrib, dataclass
 
+from . import base62
 from .type_alias import TypeType
 
 _local_session = threading.local()
+COOKIE_PREFIX = "manabi_"
 
 
 def requests_session() -> requests.Session:
@@ -26,6 +27,163 @@ def requests_session() -> requests.Session:
     return session
 
 
+class LRUCache:
+    """Bounded, thread-safe mapping that evicts the least recently used entry.
+
+    `hits` and `misses` count the outcome of `get`. A `maxsize` of 0 disables the
+    cache. With a `ttl` entries expire that many seconds after they were set.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Any) -> bool:
+        if self.ttl is None:
+            return key in self._data
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > self._clock()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if self.ttl is not None:
+                expires, value = value
+                if expires <= self._clock():
+                    del self._data[key]
+                    self.misses += 1
+                    return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Any, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        if self.ttl is not None:
+            value = (self._clock() + self.ttl, value)
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data.pop(key)
+            return value if self.ttl is None else value[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class ContentHash:
+    """Streaming MD5 of a body, as S3 reports it in the ETag.
+
+    Bodies of at least `part_size` bytes are uploaded in parts, their ETag is the
+    MD5 of the MD5s of the parts followed by the number of parts.
+    """
+
+    def __init__(self, part_size: Optional[int] = None):
+        self.part_size = part_size
+        self.size = 0
+        self._part = hashlib.md5(usedforsecurity=False)
+        self._part_length = 0
+        self._digests: List[bytes] = []
+
+    def update(self, data: bytes) -> None:
+        part_size = self.part_size
+        if part_size is None:
+            self._part.update(data)
+            self.size += len(data)
+            return
+        view = memoryview(data)
+        while view:
+            chunk = view[: part_size - self._part_length]
+            self._part.update(chunk)
+            self._part_length += len(chunk)
+            self.size += len(chunk)
+            view = view[len(chunk) :]
+            if self._part_length == part_size:
+                self._digests.append(self._part.digest())
+                self._part = hashlib.md5(usedforsecurity=False)
+                self._part_length = 0
+
+    @property
+    def etag(self) -> str:
+        if not self._digests:
+            return self._part.hexdigest()
+        digests = list(self._digests)
+        if self._part_length:
+            digests.append(self._part.digest())
+        joined = hashlib.md5(b"".join(digests), usedforsecurity=False)
+        return f"{joined.hexdigest()}-{len(digests)}"
+
+
+class RateLimiter:
+    """Token bucket per client.
+
+    Every client may `hit` `burst` times, then it is `limited` until the bucket
+    refills at `rate` tokens per second. Only the `maxsize` most recent clients are
+    tracked.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        maxsize: int = 4096,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._clock = clock
+        self._buckets: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _tokens(self, client: Any, now: float) -> float:
+        tokens, last = self._buckets.get(client, (self.burst, now))
+        return min(self.burst, tokens + (now - last) * self.rate)
+
+    def limited(self, client: Any) -> bool:
+        with self._lock:
+            if client not in self._buckets:
+                return False
+            return self._tokens(client, self._clock()) < 1
+
+    def hit(self, client: Any) -> None:
+        with self._lock:
+            now = self._clock()
+            tokens = max(0, self._tokens(client, now) - 1)
+            self._buckets[client] = (tokens, now)
+            self._buckets.move_to_end(client)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+
+
 def cattrib(
     attrib_type: Optional[TypeType] = None,
     check: Optional[Callable] = None,
@@ -70,32 +228,120 @@ def from_string(data: str) -> bytes:
     return base62.decodebytes(data)
 
 
-@dataclass
+@dataclass(slots=True)
 class AppInfo:
     start_response: Callable = cattrib(check=lambda x: callable(x))
     environ: Dict[str, Any] = cattrib(dict)
     secure: bool = cattrib(bool, default=True)
 
+    @classmethod
+    def trusted(
+        cls, start_response: Callable, environ: Dict[str, Any], secure: bool
+    ) -> "AppInfo":
+        """Create an AppInfo without running the validators, see Token.trusted."""
+        info = object.__new__(cls)
+        object.__setattr__(info, "start_response", start_response)
+        object.__setattr__(info, "environ", environ)
+        object.__setattr__(info, "secure", secure)
+        return info
 
-def set_cookie(
-    info: AppInfo,
-    key: str,
-    value: str,
-    ttl: int,
-    status: int,
-    headers: List[Tuple[str, str]],
-    exc_info=None,
-):
-    cookie: SimpleCookie = SimpleCookie()
-    cookie[key] = value
-    date = datetime.now(UTC)
-    unixtime = calendar.timegm(date.utctimetuple())
-    cookie[key]["expires"] = get_rfc1123_time(unixtime + ttl)
-    if info.secure:
-        cookie[key]["secure"] = True
-        cookie[key]["httponly"] = True
-    headers.append(cast("Tuple[str, str]", tuple(str(cookie).split(": "))))
-    info.start_response(status, headers, exc_info)
+
+def get_cookie(header: str, name: str) -> Optional[str]:
+    """Return the value of cookie `name` from a Cookie header.
+
+    Only scans for `name`, unlike SimpleCookie, which parses every cookie.
+    """
+    needle = f"{name}="
+    start = 0
+    while True:
+        index = header.find(needle, start)
+        if index < 0:
+            return None
+        if index == 0 or header[index - 1] in "; ":
+            index += len(needle)
+            end = header.find(";", index)
+            value = header[index:end] if end >= 0 else header[index:]
+            value = value.strip()
+            if len(value) > 1 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+            return value
+        start = index + 1
+
+
+def cookie_name(ciphertext: str) -> str:
+    """Return a short cookie name for the refresh cookie of a token.
+
+    The length doesn't depend on the token, which keeps cookie headers small.
+    """
+    digest = hashlib.blake2b(ciphertext.encode("UTF-8"), digest_size=12).hexdigest()
+    return f"{COOKIE_PREFIX}{digest}"
+
+
+_http_date: Tuple[int, str] = (-1, "")
+
+
+def http_date(secs: int) -> str:
+    """Return get_rfc1123_time(secs), the last result is cached.
+
+    Responses of the same second share the string.
+    """
+    global _http_date
+    cached = _http_date
+    if cached[0] != secs:
+        cached = _http_date = (secs, get_rfc1123_time(secs))
+    return cached[1]
+
+
+class SetCookie:
+    """Builds Set-Cookie headers, the static attributes are rendered once.
+
+    Per request only the value and the expiry date are formatted.
+    """
+
+    _expired = get_rfc1123_time(0)
+
+    def __init__(self, ttl: int, secure: bool = True, path: Optional[str] = None):
+        self.ttl = ttl
+        # Same order as SimpleCookie renders them
+        attributes = []
+        if secure:
+            attributes.append("HttpOnly")
+        if path:
+            attributes.append(f"Path={path}")
+        if secure:
+            attributes.append("Secure")
+        self._attributes = "".join(f"; {a}" for a in attributes)
+
+    def header(self, name: str, value: str) -> Tuple[str, str]:
+        expires = http_date(int(time.time()) + self.ttl)
+        return ("Set-Cookie", f"{name}={value}; expires={expires}{self._attributes}")
+
+    def expire_header(self, name: str) -> Tuple[str, str]:
+        # The browser only replaces the cookie with the same path
+        return (
+            "Set-Cookie",
+            f'{name}=""; expires={self._expired}; Max-Age=0{self._attributes}',
+        )
+
+    def start_response(
+        self,
+        start_response: Callable,
+        name: str,
+        value: str,
+        status: str,
+        headers: List[Tuple[str, str]],
+        exc_info=None,
+        *,
+        expire: Sequence[str] = (),
+    ):
+        """Set cookie `name` and expire the cookies named in `expire`.
+
+        Use it with functools.partial as start_response of the next app.
+        """
+        headers.append(self.header(name, value))
+        for old in expire:
+            headers.append(self.expire_header(old))
+        return start_response(status, headers, exc_info)
 
 
 def get_boto_client(
@@ -1,9 +1,24 @@
+import hashlib
+import time
+from http.cookies import SimpleCookie
 from typing import Callable
 
 import pytest
 from attr import dataclass
 
-from .util import cattrib, from_string, to_string
+from .util import (
+    AppInfo,
+    ContentHash,
+    LRUCache,
+    RateLimiter,
+    SetCookie,
+    cattrib,
+    from_string,
+    get_cookie,
+    get_rfc1123_time,
+    http_date,
+    to_string,
+)
 
 
 def test_hello_world():
@@ -21,3 +36,154 @@ def test_callable():
         # well we want to test what happens if it is not correctly typed
         CallableClass(True)  # type: ignore
     CallableClass(test_callable)
+
+
+def test_app_info_trusted():
+    info = AppInfo.trusted(test_callable, {}, False)
+    assert info == AppInfo(test_callable, {}, False)
+    with pytest.raises(TypeError):
+        info.environ = []  # type: ignore
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert "c" in cache
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert cache.pop("a") == 1
+    cache.clear()
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_lru_cache_disabled():
+    cache = LRUCache(0)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+
+def test_lru_cache_ttl():
+    now = [0.0]
+    cache = LRUCache(2, ttl=10, clock=lambda: now[0])
+    cache.set("a", 1)
+    now[0] = 5
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    assert "a" in cache
+    now[0] = 10
+    assert "a" not in cache
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert cache.pop("b") == 2
+    assert cache.pop("b") is None
+
+
+def test_content_hash():
+    def md5(data: bytes):
+        return hashlib.md5(data, usedforsecurity=False)
+
+    content = ContentHash()
+    content.update(b"hel")
+    content.update(b"lo")
+    assert content.etag == md5(b"hello").hexdigest()
+    parts = ContentHash(2)
+    for data in (b"h", b"ell", b"o"):
+        parts.update(data)
+    digests = b"".join(md5(part).digest() for part in (b"he", b"ll", b"o"))
+    assert parts.etag == f"{md5(digests).hexdigest()}-3"
+    assert parts.size == 5
+    small = ContentHash(8)
+    small.update(b"hello")
+    assert small.etag == content.etag
+
+
+@pytest.mark.parametrize(
+    ("header", "name", "expect"),
+    [
+        ("a=1", "a", "1"),
+        ("a=1; b=2", "b", "2"),
+        ("ba=1; a=2", "a", "2"),
+        ("b=a=1; a=2", "a", "2"),
+        ("a=1;b=2", "b", "2"),
+        ('a="1 2"; b=3', "a", "1 2"),
+        ("a=; b=3", "a", ""),
+        ("a=1", "b", None),
+        ("", "a", None),
+    ],
+)
+def test_get_cookie(header, name, expect):
+    assert get_cookie(header, name) == expect
+    morsel = SimpleCookie(header).get(name)
+    if expect is not None and morsel:
+        assert morsel.value == expect
+
+
+def test_http_date():
+    assert http_date(1000) == get_rfc1123_time(1000)
+    assert http_date(1000) is http_date(1000)
+    assert http_date(2000) == get_rfc1123_time(2000)
+
+
+@pytest.mark.parametrize("secure", [True, False])
+@pytest.mark.parametrize("path", [None, "/dav"])
+def test_set_cookie(secure, path):
+    cookie: SimpleCookie = SimpleCookie()
+    cookie["a"] = "b.c"
+    cookie["a"]["expires"] = get_rfc1123_time(int(time.time()) + 60)
+    if secure:
+        cookie["a"]["secure"] = True
+        cookie["a"]["httponly"] = True
+    if path:
+        cookie["a"]["path"] = path
+    set_cookie = SetCookie(60, secure, path)
+    assert set_cookie.header("a", "b.c") == tuple(str(cookie).split(": "))
+    cookie["a"] = ""
+    cookie["a"]["expires"] = get_rfc1123_time(0)
+    cookie["a"]["max-age"] = 0
+    name, expire = set_cookie.expire_header("a")
+    assert name == "Set-Cookie"
+    # Same attributes, in another order
+    assert sorted(expire.split("; ")) == sorted(cookie["a"].OutputString().split("; "))
+    if path:
+        assert f"Path={path}" in set_cookie.header("a", "b.c")[1].split("; ")
+        assert f"Path={path}" in expire.split("; ")
+
+    calls = []
+    set_cookie.start_response(
+        lambda *args: calls.append(args), "a", "b.c", "200 OK", [], expire=["x"]
+    )
+    (status, headers, exc_info), *_ = calls
+    assert status == "200 OK"
+    assert [h[1].partition("=")[0] for h in headers] == ["a", "x"]
+
+
+def test_rate_limiter():
+    clock = [0.0]
+    limiter = RateLimiter(0.5, 2, maxsize=2, clock=lambda: clock[0])
+    assert not limiter.limited("a")
+    limiter.hit("a")
+    assert not limiter.limited("a")
+    limiter.hit("a")
+    assert limiter.limited("a")
+    assert not limiter.limited("b")
+    clock[0] = 2.0
+    assert not limiter.limited("a")
+    limiter.hit("a")
+    assert limiter.limited("a")
+    clock[0] = 100.0
+    limiter.hit("a")
+    limiter.hit("a")
+    assert limiter.limited("a")
+    limiter.hit("b")
+    limiter.hit("c")
+    # Only the most recent clients are tracked
+    assert not limiter.limited("a")
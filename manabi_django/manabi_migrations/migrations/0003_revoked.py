@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("manabi_migrations", "0002_alter_lock_token"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Revoked",
+            fields=[
+                (
+                    "token",
+                    models.TextField(primary_key=True, serialize=False),
+                ),
+            ],
+            options={
+                "db_table": "manabi_revoked",
+            },
+        ),
+    ]
@@ -7,3 +7,10 @@ class Lock(models.Model):
 
     class Meta:
         db_table = "manabi_lock"
+
+
+class Revoked(models.Model):
+    token = models.TextField(primary_key=True)
+
+    class Meta:
+        db_table = "manabi_revoked"